@@ -0,0 +1,90 @@
+""" cache.py
+    --------
+    The boot cache. Parsing thousands of zone and room files makes for a slow boot, so what they parse into
+    is kept in one file, and only files that have changed since (by their size and modification time) are
+    parsed again. Delete the cache file at any time; the next boot just takes longer.
+
+    A file is known by its modification time, size and inode. On filesystems that only keep modification
+    times to the second, an edit in the same second as the last one could keep all three, so files that
+    changed only just before they were read are never trusted from the cache. (See RACY.)
+"""
+
+from libs.log import log
+import marshal, os, time
+
+PATH = 'world/boot.cache' # Where the cache is kept.
+VERSION = 2               # Change this whenever the parsed data changes shape, so old caches are thrown out.
+RACY = 2.0                # Files changed less than this many seconds before they're read are read again next time.
+
+ENTRIES = {} # What the cache held at boot: each path, with (stamp, parsed data). (See stamp().)
+USED = {}    # The same, for every file asked for since. This is what gets saved, so files that are gone drop out.
+READ = 0     # How many files have actually been read and parsed, rather than taken from the cache.
+
+def add(path, entry):
+    # Add a file that's been read elsewhere, as an entry from entry().
+    global READ
+    ENTRIES[path] = entry
+    USED[path] = entry
+    READ = READ + 1
+
+def entry(path, reader):
+    # Read a file with reader(path), and make a cache entry of it: (stamp, parsed data).
+    info = os.stat(path) # Before reading, so that if it changes in the meantime, it's read again next time.
+    if(time.time() - info.st_mtime < RACY):
+        # It's only just changed, and could change again without its stamp changing. Don't trust it next time.
+        return (None, reader(path))
+    return (stamp(info), reader(path))
+
+def fresh(path):
+    # Is the file at (path) cached, and unchanged since?
+    cached = ENTRIES.get(path)
+    return (cached != None and cached[0] != None and cached[0] == stamp(os.stat(path)))
+
+def get(path, reader):
+    # Get the parsed contents of the file at (path). If it's changed, or isn't cached, reader(path) parses it.
+    if(not fresh(path)):
+        # It's new, or it's changed. Read it for real.
+        add(path, entry(path, reader))
+    return use(path)
+
+def load():
+    # Load the cache from disk. If it's missing, damaged or out of date, start with an empty one.
+    global READ
+    ENTRIES.clear()
+    USED.clear()
+    READ = 0
+    try:
+        with open(PATH, 'rb') as cache_file:
+            cached = marshal.load(cache_file)
+        if(cached['version'] == VERSION):
+            ENTRIES.update(cached['files'])
+    except IOError:
+        # There's no cache yet.
+        pass
+    except (EOFError, ValueError, TypeError, KeyError):
+        log('The boot cache is damaged. Everything will be read from scratch.', '!')
+
+def use(path):
+    # Get the parsed contents of a file that's already been checked with fresh(), or added since, without checking it again.
+    USED[path] = ENTRIES[path]
+    return ENTRIES[path][1]
+
+def stamp(info):
+    # What tells one version of a file from another, given its os.stat(): its modification time, to a fraction of a
+    # second where the filesystem keeps one, its size, and its inode, which changes whenever an editor saves by replacing it.
+    return (info.st_mtime, info.st_size, info.st_ino)
+
+def stale(paths):
+    # Which of (paths) need reading?
+    return [path for path in paths if not fresh(path)]
+
+def save():
+    # Save the cache, if anything has changed since it was loaded. Call this once the world has finished loading.
+    log('%d files read, %d from the boot cache.' % (READ, len(USED) - READ), '>')
+    if(READ == 0 and len(USED) == len(ENTRIES)):
+        # Nothing's changed, so there's nothing to save.
+        return
+    temporary = '%s.tmp' % (PATH)
+    with open(temporary, 'wb') as cache_file:
+        marshal.dump({'version': VERSION, 'files': USED}, cache_file)
+    os.rename(temporary, PATH) # Never leave half a cache where the next boot will find it.
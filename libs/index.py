@@ -0,0 +1,106 @@
+""" index.py
+    --------
+    A sorted index of words, for finding a word from the first few letters of it.
+"""
+
+from bisect import bisect_left, insort
+
+class index:
+    
+    def add(self, word, value = None):
+        # Add a word to the index, along with whatever it stands for. Adding it again replaces the value.
+        lower = word.lower()
+        if(lower not in self.ENTRIES):
+            insort(self.WORDS, lower) # Keep the list of words in order.
+        self.ENTRIES[lower] = (word, value)
+    
+    
+    def attach(self, word, key):
+        # For indexes where several things can share a word, like two sessions logged in as the same character:
+        # add (key) to the list stored under the word, newest last, adding the word if it's new.
+        keys = self.get(word)
+        if(keys == None):
+            self.add(word, [key])
+        elif(key not in keys):
+            keys.append(key)
+    
+    
+    def complete(self, prefix, overlay = None):
+        # Find the word that the prefix is short for. An exact match wins, then the first word alphabetically.
+        # If an overlay index is given, it's searched as though its words were part of this one.
+        prefix = prefix.lower()
+        if(prefix in self.ENTRIES):
+            return self.ENTRIES[prefix][0]
+        if(overlay != None and prefix in overlay.ENTRIES):
+            return overlay.ENTRIES[prefix][0]
+        
+        # There's no exact match, so find the first word that starts with the prefix.
+        found = self._first(prefix)
+        if(overlay != None):
+            other = overlay._first(prefix)
+            if(other != None and (found == None or other < found)):
+                # The overlay has an earlier match.
+                return overlay.ENTRIES[other][0]
+        if(found == None):
+            return None
+        return self.ENTRIES[found][0]
+    
+    
+    def detach(self, word, key):
+        # Take (key) out of the list stored under a word. The word only leaves the index once nothing's left under it.
+        keys = self.get(word)
+        if(keys != None and key in keys):
+            keys.remove(key)
+            if(keys == []):
+                self.remove(word)
+    
+    
+    def get(self, word, default = None):
+        # Get the value stored for a word.
+        lower = word.lower()
+        if(lower in self.ENTRIES):
+            return self.ENTRIES[lower][1]
+        return default
+    
+    
+    def remove(self, word):
+        # Take a word out of the index.
+        lower = word.lower()
+        if(lower in self.ENTRIES):
+            del self.ENTRIES[lower]
+            del self.WORDS[bisect_left(self.WORDS, lower)]
+            return True
+        return False
+    
+    
+    def words(self):
+        # Return every word in the index, in order.
+        return [self.ENTRIES[lower][0] for lower in self.WORDS]
+    
+    
+    def _first(self, prefix):
+        # Find the first (lowercase) word that starts with the prefix, or None.
+        i = bisect_left(self.WORDS, prefix)
+        if(i < len(self.WORDS) and self.WORDS[i].startswith(prefix)):
+            return self.WORDS[i]
+        return None
+    
+    
+    def __contains__(self, word):
+        # Check if a word is in the index.
+        return word.lower() in self.ENTRIES
+    
+    
+    def __len__(self):
+        # Count the words in the index.
+        return len(self.WORDS)
+    
+    
+    def __init__(self, words = None):
+        # Create the index, optionally from a dict of words and their values.
+        self.WORDS = []   # Every word, in lowercase, in sorted order.
+        self.ENTRIES = {} # Each lowercase word, with the word as it was given and its value.
+        if(words != None):
+            for word in words:
+                self.ENTRIES[word.lower()] = (word, words[word])
+            self.WORDS = sorted(self.ENTRIES.keys()) # Sort them all at once, rather than one at a time.
@@ -0,0 +1,82 @@
+""" password.py
+    -----------
+    Password hashing. A good hash is slow on purpose, so the work is done on background threads instead
+    of in the game loop. Hashes are stored as 'pbkdf2_sha256$iterations$salt$hash'.
+"""
+
+from libs.log import log
+import hashlib, hmac, binascii, os, threading, traceback, Queue
+
+ALGORITHM  = 'pbkdf2_sha256' # The name stored at the front of each hash.
+ITERATIONS = 50000           # How many rounds of hashing? More is slower for us, and for anyone guessing passwords.
+WORKERS    = 1               # How many threads do the hashing? Each one competes with the game loop for a CPU.
+
+JOBS = Queue.Queue() # Jobs waiting for a worker.
+OUTSTANDING = []     # Jobs that have been submitted, and haven't been seen finished yet.
+THREADS = []         # The worker threads, once they've been started.
+
+class job:
+    """ A piece of hashing work, and its result once it's done. """
+    
+    def __init__(self, task, args):
+        # Create the job. The worker will call task(*args) and keep whatever it returns.
+        self.TASK = task
+        self.ARGS = args
+        self.RESULT = None # What the task returned. None if it failed.
+        self.DONE = False  # Has a worker finished with it?
+
+def busy():
+    # Are there any jobs that haven't finished yet? Only the game loop should call this.
+    OUTSTANDING[:] = [item for item in OUTSTANDING if not item.DONE]
+    return len(OUTSTANDING) > 0
+
+def encode(password, salt = None, iterations = ITERATIONS):
+    # Hash a password for storage. This is the slow part, so it belongs on a worker.
+    if(salt == None):
+        salt = binascii.hexlify(os.urandom(16)) # Every password gets its own salt.
+    digest = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    return '%s$%d$%s$%s' % (ALGORITHM, iterations, salt, binascii.hexlify(digest))
+
+def legacy(password):
+    # The old way of storing passwords: an unsalted sha1 hash.
+    return hashlib.sha1(password.encode("utf8")).hexdigest()
+
+def submit(task, *args):
+    # Queue up task(*args) for a worker, and return the job so the caller can check on it.
+    while(len(THREADS) < WORKERS):
+        # Start the workers the first time they're needed.
+        thread = threading.Thread(target = work)
+        thread.daemon = True # Don't hold up a shutdown or reboot for them.
+        thread.start()
+        THREADS.append(thread)
+    item = job(task, args)
+    OUTSTANDING.append(item)
+    JOBS.put(item)
+    return item
+
+def verify(password, stored):
+    # Check a password against a stored hash. Returns (correct, upgraded), where upgraded is a new
+    # hash to store in place of an old-style one, or None if the stored hash is fine as it is.
+    try:
+        if(stored.startswith(ALGORITHM + '$')):
+            # A current hash. Hash the password the same way and compare.
+            (algorithm, iterations, salt, digest) = stored.split('$')
+            return (hmac.compare_digest(encode(password, salt, int(iterations)), stored), None)
+        elif(stored != '' and hmac.compare_digest(legacy(password), stored)):
+            # An old sha1 hash, and it matches. Now's our chance to replace it.
+            return (True, encode(password))
+    except (ValueError, UnicodeError):
+        # The stored hash is mangled, or the password can't be encoded the old way. Either way, no match.
+        pass
+    return (False, None)
+
+def work():
+    # A worker thread. Take jobs from the queue and run them, forever.
+    while(True):
+        item = JOBS.get()
+        try:
+            item.RESULT = item.TASK(*item.ARGS)
+        except Exception:
+            # Leave the result as None, and let the admins know what went wrong.
+            log('Password job failed:\n%s' % (traceback.format_exc().rstrip()), '!')
+        item.DONE = True
@@ -4,78 +4,105 @@
 """
 
 from libs.log import log
-import textwrap, glob, hashlib, datetime
+from libs import password, store, writer
+from miniboa.xterm import colorize
+from collections import deque
+import textwrap, datetime, time
 
-def hash(string):
-    # Get the sha1 hash of the provided string.
-    return hashlib.sha1(string.encode("utf8")).hexdigest() # Return the hash.
-
-def wrap(message, rows, columns):
-    # Force line-wrapping for a message. This automatically conforms to the user's window size.
+def wrap_lines(message, columns):
+    # Wrap a message to the given width, and return the list of lines.
     lines = message.split('\n') # We want to respect pre-existing line-breaks.
     output = []                 # This is our output buffer.
     for line in lines:
         # For each line, let's wrap it.
         output += textwrap.wrap(line, width=columns) # Wrap the lines.
+    return output
+
+def paginate(lines, rows):
     # Now we need to get only enough lines that we can print to the screen.
     rows = rows - 2 # Give us some wiggle room.
-    buff = '\n'.join(output[rows:])   # The buffer remaining.
-    output = '\n'.join(output[:rows]) # The output.
+    buff = '\n'.join(lines[rows:])   # The buffer remaining.
+    output = '\n'.join(lines[:rows]) # The output.
     if(buff != ''):
         # There's an overflow, so let's tell the user to hit 'enter' to continue.
         output += '\n(Hit enter to continue, or type a command.)'
     return (buff, output) # Then return them.
 
+def percentile(samples, fraction):
+    # Pick a percentile from a sorted list of samples. (fraction) picks which, so 0.5 is the median. Zero if there are no samples.
+    if(samples == []):
+        return 0.0
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+def render(message, rows, columns, ansi, prompt):
+    # Format a message for one kind of screen. This returns the overflow buffer and the text, ready for the wire.
+    return render_lines(wrap_lines(message, columns), rows, ansi, prompt)
+
+def render_lines(lines, rows, ansi, prompt):
+    # Just like render(), but for a message that's already been wrapped.
+    (buff, output) = paginate(lines, rows)                          # Fit it to the screen,
+    output = colorize('\n%s\n%s ' % (output, prompt), ansi)        # add the prompt and convert the colors,
+    return (buff, output.replace('\n', '\r\n'))                    # then fix the line endings.
+
 class player:
     """ Each connected client becomes a player! """
     
-    def check_pass(self, password):
-        # Check the password to see if it fits the character.
-        correct = False # We're going to assume it's false until we're told otherwise.
-        try:
-            # Now, open their player file and read its contents, then split it by line.
-            lines = open('world/players/%s.plr' % (self.NAME), 'r').read().split('\n')
-            for line in lines:
-                # Then, find the line that tells us the user's password.
-                if(line.find('pass') != -1):
-                    # Once we've found it, pull the password from the file.
-                    pwd = line.split(':')[1]
-                    if(pwd == password):
-                        # If the passwords match, set 'correct' to True. Otherwise it'll return False.
-                        correct = True
-        except:
-            # There was a problem reading their file.
-            pass # I'll think of something better to do here later.
-        return correct
+    QUEUE_DEPTH = 20  # How many commands can wait in a player's queue?
+    INPUT_RATE  = 4.0 # How many commands per second can a player send, on average?
+    INPUT_BURST = 10  # How many can they send at once, after being quiet for a while?
+    LATENCY_SAMPLES = 100 # How many of their latest commands do we keep timings for?
+    
+    def busy(self):
+        # Does this player have work waiting for the world's next pass?
+        if(self.JOB != None):
+            # Not until their password's been hashed. The world keeps an eye on that.
+            return False
+        if(self.STATE in ('new', 'authenticated', 'logout')):
+            # They're mid-way through connecting or disconnecting.
+            return True
+        if(self.CLIENT.cmd_ready):
+            # They've sent input we haven't read yet.
+            return True
+        # Otherwise, it depends on whether a queued command is allowed to run.
+        return (len(self.QUEUE) > 0 and self.ready_for_next_command())
     
     
     def cleanup(self):
         # Clean and save the player for shutdown.
+        logged_in = self.STATE in ('authenticated', 'live')
         self.STATE = 'logout'
-        self.save()
+        if(self.DROPPED > 0):
+            # Let the admins know if they've been flooding.
+            log('%s (%s) had %d commands dropped, and %d queued.' % (self.ID, self.NAME, self.DROPPED, self.QUEUED), '!')
+        if(logged_in and self.DIRTY):
+            # Only save characters that have been loaded, and changed. Anyone still logging in would overwrite theirs with a blank one.
+            self.save()
     
     
     def first_player(self):
         # Is this the first player created?
-        players = glob.glob('world/players/*.plr') # Get a list of all players.
-        if(len(players) > 0):
-            # There are already players.
-            return False
-        return True
+        return (store.count() == 0)
+    
+    
+    def get_record(self):
+        # Get the character as a record for the player store.
+        return {
+            'name': self.NAME,
+            'pass': self.PASSWORD,
+            'role': self.ROLE,
+            'sex' : self.SEX,
+            'room': self.ROOM
+        }
+    
+    
+    def latency(self, fraction):
+        # How long their recent commands waited to be processed. (fraction) picks the percentile, so 0.5 is the median.
+        return percentile(sorted(self.LATENCY), fraction)
     
     
     def player_exists(self, name):
         # Determine if the player exists or not.
-        players = glob.glob('world/players/*.plr') # Get a list of all players.
-        for item in players:
-            # Check each player for a match.
-            filename = item.split('/')[-1] # Get the short filename.
-            player_name = filename.split('.')[0] # Get the player name.
-            if(name == player_name):
-                # We have a match! The player already exists.
-                return True
-        # If we reach this point, the player hasn't yet been created.
-        return False
+        return store.exists(name)
     
     
     def process_input(self):
@@ -89,7 +116,7 @@ class player:
             if(self.CLIENT.active):
                 # The user is still alive and logging in.
                 command = None
-                if(self.CLIENT.cmd_ready):
+                if(self.CLIENT.cmd_ready and self.JOB == None):
                     # They've got a command waiting.
                     command = self.CLIENT.get_command().strip() # So grab it.
                 
@@ -110,17 +137,32 @@ class player:
                         if(self.player_exists(self.NAME)):
                             # This player has already been created.
                             self.state_change('get_password','\nWhat is the password for that character? ')
+                        elif(self.NAME in self.RESERVED):
+                            # The name is a command, or something else that would be confusing as a name.
+                            self.state_change('get_name', '\nThat name is reserved. Please choose another.\n\nWhat is the name of your character? ')
                         else:
                             # This player is new!
                             self.state_change('verify_name','\nDid I get that right, %s? [y/n] ' % (self.NAME))
                 
                 elif(command and self.STATE == 'get_password'):
                     # They have chosen a pre-existing character, so we need to make sure the password is legit.
-                    pwd = hash(command.strip()) # Get the sha1 hash of that password.
-                    if(self.check_pass(pwd)):
+                    self.RECORD = store.load(self.NAME) or {'pass': ''} # Read the character, just this once.
+                    self.JOB = password.submit(password.verify, command, self.RECORD['pass']) # Hash it in the background,
+                    self.state_change('check_password')                                       # and wait for the answer.
+                
+                elif(self.STATE == 'check_password' and self.JOB.DONE):
+                    # Their password has been checked.
+                    (correct, upgraded) = self.JOB.RESULT or (False, None)
+                    self.JOB = None
+                    if(correct):
                         # Correct password.
                         self.state_change('authenticated','\nWelcome back!\n\n')
-                        self.restore() # Load the character from its file.
+                        self.restore(self.RECORD) # Load the character from what we read.
+                        if(upgraded != None):
+                            # They had an old-style hash. Store the new one in its place.
+                            self.PASSWORD = upgraded
+                            self.save()
+                            log('Password hash upgraded (%s).' % (self.NAME), '>')
                     else:
                         # Incorrect password.
                         self.state_change('get_password','\nIncorrect password, please try again.\nWhat is the password for that character? ')
@@ -135,18 +177,32 @@ class player:
                         self.state_change('get_name','\nAlright, well who are you, then? ')
                 
                 elif(command and self.STATE == 'choose_password'):
-                    # They've chosen a password.
-                    self.PASSWORD = hash(command) # Get its hash.
+                    # They've chosen a password. Hang on to it until they've typed it again.
+                    self.CHOSEN = command
                     self.state_change('verify_password','\nPlease type your password again. ')
                 
                 elif(command and self.STATE == 'verify_password'):
                     # They've attempted to verify their chosen password.
-                    if(self.PASSWORD == hash(command)):
-                        # We've got a match.
-                        self.state_change('choose_gender','\nPlease choose a gender. [m/f] ')
+                    if(self.CHOSEN == command):
+                        # We've got a match. Now hash it in the background, and wait for the answer.
+                        self.JOB = password.submit(password.encode, command)
+                        self.state_change('hash_password')
                     else:
                         # Nope.
                         self.state_change('choose_password','\nBad match. What password would you like? ')
+                    self.CHOSEN = '' # Either way, we're done with it.
+                
+                elif(self.STATE == 'hash_password' and self.JOB.DONE):
+                    # Their new password has been hashed.
+                    hashed = self.JOB.RESULT
+                    self.JOB = None
+                    if(hashed != None):
+                        # All set.
+                        self.PASSWORD = hashed
+                        self.state_change('choose_gender','\nPlease choose a gender. [m/f] ')
+                    else:
+                        # Something went wrong, so have them try again.
+                        self.state_change('choose_password','\nSorry, something went wrong. What password would you like? ')
                 
                 elif(command and self.STATE == 'choose_gender'):
                     # Male, Female, take your pick.
@@ -185,7 +241,7 @@ class player:
                 elif(command.lower() == 'halt'):
                     # The 'halt' command clears all commands on the stack. It must be typed in full, not auto-completed.
                     self.send('Command queue cleared.') # Acknowledge the command,
-                    self.QUEUE = []                     # then get it done.
+                    self.QUEUE.clear()                  # then get it done.
                     self.WAIT  = 0                      # Also, now that there are no queued commands, there's no reason to wait.
                     command = ''                        # Set the command to an empty string so it isn't added.
                 elif(command == '!'):
@@ -193,12 +249,12 @@ class player:
                     command = self.LAST_CMD
                 # Now, add the command to the queue.
                 if(command != ''):
-                    self.LAST_CMD = command    # Set this as the last issued command.
-                    self.QUEUE.append(command) # Then append it to the command queue.
+                    self.LAST_CMD = command     # Set this as the last issued command.
+                    self.queue_command(command) # Then append it to the command queue, if there's room.
                 
             if(self.ready_for_next_command() and len(self.QUEUE) > 0):
                 # If we're ready for the player's next action, send it off.
-                return self.QUEUE.pop(0)
+                return self.QUEUE.popleft()
             else:
                 # Otherwise, return an empty string.
                 return ''
@@ -210,6 +266,35 @@ class player:
         return prompt # Return their prompt.
     
     
+    def queue_command(self, command):
+        # Add a command to the queue, unless they're sending too many too fast. Returns whether it was added.
+        now = time.time()
+        self.TOKENS = min(self.TOKENS + (now - self.TOKEN_TIME) * self.INPUT_RATE, self.INPUT_BURST) # Earn back tokens for the time that's passed.
+        self.TOKEN_TIME = now
+        if(self.TOKENS < 1):
+            # They're sending commands faster than we'll take them.
+            reason = "You're sending commands too quickly."
+        elif(len(self.QUEUE) >= self.QUEUE_DEPTH):
+            # They've got plenty waiting already.
+            reason = "Your command queue is full. (Type 'halt' to clear it.)"
+        else:
+            # There's room, so queue it up.
+            self.TOKENS = self.TOKENS - 1
+            self.QUEUE.append(command)
+            self.QUEUED = self.QUEUED + 1
+            self.FLOODING = False
+            return True
+        
+        # The command has to be dropped.
+        self.DROPPED = self.DROPPED + 1
+        if(not self.FLOODING):
+            # Only tell them (and the log) once, rather than once for every line of the flood.
+            self.FLOODING = True
+            self.send('%s Command dropped: %s' % (reason, command))
+            log('%s (%s) is flooding. Dropping commands.' % (self.ID, self.NAME), '!')
+        return False
+    
+    
     def quit(self):
         # The player has decided to quit.
         self.send('Come back soon!')
@@ -226,54 +311,44 @@ class player:
             return True
     
     
-    def restore(self):
-        # Load the character from a file.
-        filename = 'world/players/%s.plr' % (self.NAME) # Get the filename.
-        data = open(filename,'r').read().split('\n')    # Read its lines into a list.
-        for line in data:
-            setting = line.split(':')[0] # This defines what is being set.
-            if(setting == 'name'):
-                # Load the name from the list.
-                self.NAME = line.split(':')[1]
-            elif(setting == 'pass'):
-                # Load the password from the list.
-                self.PASSWORD = line.split(':')[1]
-            elif(setting == 'room'):
-                # Load the room from the list.
-                self.ROOM = line.split(':')[1]
-            elif(setting == 'sex'):
-                # Load the gender from the list.
-                self.SEX = line.split(':')[1]
-            elif(setting == 'role'):
-                # Load the role from the list.
-                self.ROLE = int(line.split(':')[1])
+    def restore(self, record):
+        # Load the character from a record in the player store.
+        self.NAME = record['name']
+        self.PASSWORD = record['pass']
+        self.ROLE = record['role']
+        self.SEX = record['sex']
+        self.ROOM = record['room']
+        self.RECORD = None # We're done with it.
         log('Character loaded (%s).' % (self.NAME), '>')
     
     
     def save(self):
-        # Save this character to a file.
-        filename = 'world/players/%s.plr' % (self.NAME) # Get the filename.
-        save_file = open(filename,'w') # Open the save file.
-        lines = [
-            'name:%s' % (self.NAME),
-            'pass:%s' % (self.PASSWORD),
-            'role:%d' % (self.ROLE),
-            'sex:%s'  % (self.SEX),
-            'room:%s' % (self.ROOM)
-        ]
-        for line in lines:
-            # Write the lines to the file.
-            save_file.write('%s\n' % (line))
-        save_file.close() # Close the file.
+        # Save this character to the player store. The writer does the writing, in the background.
+        writer.save_player(self.get_record())
+        self.DIRTY = False # It's as good as written.
         log('Character saved (%s).' % (self.NAME), '<')
     
     
+    def screen(self):
+        # Everything that decides how a message is rendered for this player. Players with the same screen get the same output.
+        return (self.CLIENT.rows, self.CLIENT.columns, self.CLIENT.use_ansi, self.prompt())
+    
+    
     def send(self, message):
         # Send a message to the player.
-        rows = self.CLIENT.rows
-        columns = self.CLIENT.columns
-        (self.BUFFER, output) = wrap(message, rows, columns)
-        self.CLIENT.send_cc('\n%s\n%s ' % (output, self.prompt()))
+        self.send_rendered(render(message, *self.screen()))
+    
+    
+    def send_lines(self, lines):
+        # Send a message that's already been wrapped to this player's screen width.
+        (rows, columns, ansi, prompt) = self.screen()
+        self.send_rendered(render_lines(lines, rows, ansi, prompt))
+    
+    
+    def send_rendered(self, rendered):
+        # Send a message that's already been rendered for this player's screen.
+        (self.BUFFER, output) = rendered
+        self.CLIENT.send_raw(output)
     
     
     def set_tick_delay(self, ticks):
@@ -296,21 +371,34 @@ class player:
         if(self.WAIT > 0):
             # If we're still waiting on ticks to pass,
             self.WAIT = self.WAIT - 1 # Decrement the counter.
-        self.CLIENT.request_naws()
+        return (self.WAIT > 0) # Do they still need ticking?
     
     
-    def __init__(self, client):
-        # Create a new player for the newly-connected client.
+    def __init__(self, client, reserved = ()):
+        # Create a new player for the newly-connected client. New characters can't take any name in (reserved).
         self.CLIENT = client         # Assign our local client.
+        self.RESERVED = reserved     # Names that new characters aren't allowed to use.
         self.ID = client.addrport()  # Grab the player key.
         self.WAIT = 0                # Set wait to 0. This tells us how many tick we need to wait before getting the next command.
         self.STATE = 'new'           # Set the initial state of the player upon connecting.
-        self.QUEUE = []              # Create an empty command queue.
+        self.QUEUE = deque()         # Create an empty command queue.
+        self.QUEUED = 0              # How many commands they've had queued,
+        self.DROPPED = 0             # and how many were dropped for flooding.
+        self.FLOODING = False        # Are they being dropped right now?
+        self.LATENCY = deque(maxlen = self.LATENCY_SAMPLES) # How long their latest commands waited to be processed, in seconds.
+        self.TOKENS = self.INPUT_BURST # Each command costs a token, and they earn them back at INPUT_RATE per second.
+        self.TOKEN_TIME = time.time()  # When they last earned tokens.
         self.LAST_CMD = ''           # Set the last command issued by the user.
         self.TIME_CONNECTED = datetime.datetime.now() # Keep track of when this user first connected.
         self.NAME = ''               # The player's name.
         self.ROOM = '0.0'            # Set the starting room. All users start in zone 0, room 0 upon first creation.
+        self.LOCATION = None         # The room they're in, once they're in the world. ROOM is its address, for saving.
         self.PASSWORD = ''           # This is where the user's password hash is stored.
+        self.CHOSEN = ''             # A new character's password, until they've typed it twice.
+        self.JOB = None              # The password hashing job we're waiting on, if any.
+        self.RECORD = None           # Their character, as read from the player store while their password is checked.
         self.SEX = ''                # What's their gender?
         self.ROLE = 0                # Normal user by default. 0 = Normal, 1 = Moderator, 2 = Admin.
-        self.BUFFER = ''             # This is a buffer of lines, in case of overflow.
\ No newline at end of file
+        self.BUFFER = ''             # This is a buffer of lines, in case of overflow.
+        self.DIRTY = False           # Has their character changed since it was loaded or saved?
+        self.CLIENT.request_handshake() # Ask for their window size and terminal type, and offer to compress their output, all at once.
\ No newline at end of file
@@ -3,15 +3,52 @@
     This code handles rooms and their contents.
 """
 
+from libs.index import index
 from libs.log import log
+from libs.player import wrap_lines
+from libs import writer
 
 LOG_FILE_ACCESS = True # This tells whether we're going to log room loads/saves or not.
 
+def parse(text):
+    # Parse the contents of a room file into plain data: a dict of its settings, description and exits.
+    data = {'settings': [], 'desc': '', 'exits': {}}
+    lines = text.split('\n')
+    i = 0
+    while(i < len(lines)):
+        # Process each line.
+        (setting, colon, value) = lines[i].partition(':')
+        i = i + 1
+        if(setting == 'settings'):
+            # Read the settings line.
+            if(value != 'none'):
+                data['settings'] = value.split(',')
+        elif(setting == 'description'):
+            # The description is every line up to the one that's just '---'.
+            end = lines.index('---', i)
+            data['desc'] = '\n'.join(lines[i:end])
+            i = end + 1
+        elif(setting[:4] == 'exit'):
+            # We've got an exit: exit.(name):(zone.room)
+            data['exits'][setting[5:]] = value.split(':')[0]
+    return data
+
+def read(filename):
+    # Read and parse a room file.
+    return parse(open(filename, 'r').read())
+
 class room:
     
     def add_player(self, key, name):
         # Add a new player key to the list.
+        if(key not in self.PLAYERS):
+            self.NAMES.append(name) # Keep the list of names in the order people arrived.
+        else:
+            self.NAMES[self.NAMES.index(self.PLAYERS[key])] = name
+            self.NAME_INDEX.detach(self.PLAYERS[key], key)
         self.PLAYERS[key] = name
+        self.NAME_INDEX.attach(name, key) # Index their name, so they can be found by part of it.
+        self.wake() # Someone's here now, so the room needs ticking.
     
     
     def apply_settings(self, settings):
@@ -30,15 +67,25 @@ class room:
                         self.SETTINGS.append(setting)
     
     
+    def changed(self):
+        # The room has changed, and needs saving. Anything that changes it should call this.
+        self.DIRTY = True
+        if(self.PARENT is not None):
+            self.PARENT.room_changed(self)
+    
+    
     def cleanup(self):
-        # Clean up the room for shutdown.
-        self.save()
+        # Clean up the room for shutdown. It only needs saving if it's changed.
+        if(self.DIRTY):
+            self.save()
     
     
     def drop_player(self, key):
         # Remove a player from the list.
         if(key in self.PLAYERS.keys()):
-            del self.PLAYERS[key]
+            self.NAMES.remove(self.PLAYERS[key])      # Take their name off the list,
+            self.NAME_INDEX.detach(self.PLAYERS[key], key) # and out of the index, unless someone else here has it too,
+            del self.PLAYERS[key]                     # then forget them.
             return True
         else:
             return False
@@ -49,65 +96,44 @@ class room:
         return list(self.EXITS.keys())
     
     
-    def get_desc(self, viewer):
-        # Describe the room to the viewer.
-        desc = '^W^U%s^~\n%s' % (self.NAME, self.DESC)
-        exits = self.exits()
-        if(exits == []):
-            exits = ['None']
-        desc = '%s\n\n^y^UExits^u: %s^~' % (desc, (', '.join(exits)))
-        players = []
-        for key in self.PLAYERS.keys():
-            # Make a list of all players in the room except the current user.
-            if(key != viewer):
-                players.append(self.PLAYERS[key])
+    def get_filename(self):
+        # Get the path of the room's save file.
+        shortname = '%s.%s.room' % (self.ID, self.NAME)               # Get the filename.
+        return 'world/zones/%s/rooms/%s' % (self.ZONE, shortname)     # Then the entire file path.
+    
+    
+    def get_header(self):
+        # Get the part of the description that doesn't depend on who's here. It's built once, until the room changes.
+        if(self.HEADER == None):
+            desc = '^W^U%s^~\n%s' % (self.NAME, self.DESC)
+            exits = self.exits()
+            if(exits == []):
+                exits = ['None']
+            self.HEADER = '%s\n\n^y^UExits^u: %s^~' % (desc, (', '.join(exits)))
+        return self.HEADER
+    
+    
+    def get_lines(self, viewer, columns):
+        # Describe the room to the viewer, already wrapped to their screen width.
+        if(columns not in self.WRAPPED):
+            # Nobody's looked at this room with a screen this wide yet.
+            self.WRAPPED[columns] = wrap_lines(self.get_header(), columns)
+        return self.WRAPPED[columns] + wrap_lines(self.get_players(viewer), columns)
+    
+    
+    def get_players(self, viewer):
+        # List all players in the room except the viewer.
+        players = self.NAMES
+        if(viewer in self.PLAYERS):
+            i = players.index(self.PLAYERS[viewer])
+            players = players[:i] + players[i+1:]
         if(players == []):
             players = ['None']
-        desc = '%s\n^c^UPlayers^u: %s^~' % (desc, ', '.join(players))
-        return desc
-    
-    
-    def load(self):
-        # Load the room from save-file.
-        shortname = '%s.%s.room' % (self.ID, self.NAME)                # Get the filename.
-        longname  = 'world/zones/%s/rooms/%s' % (self.ZONE, shortname) # Get the entire file path.
-        lines = open(longname, 'r').read().split('\n')                 # Read the lines from the file.
-        self.EXITS = {} # Reset the exit list.
-        while(len(lines) > 0):
-            # Process each line.
-            line = lines.pop(0) # Grab a line.
-            
-            if(line.split(':')[0] == 'settings'):
-                # Read the settings line.
-                settings = line.split(':')[1]
-                if(settings == ['none']):
-                    self.SETTINGS = []
-                else:
-                    self.SETTINGS = settings.split(',')
-            
-            elif(line.split(':')[0] == 'description'):
-                # Get the room description.
-                desc = lines.pop(0) # Set the description.
-                line = lines.pop(0) # Get the next line.
-                while(line != '---'):
-                    # Continue adding lines until we're through.
-                    desc = '%s\n%s' % (desc, line) # Append the next line.
-                    line = lines.pop(0) # Then grab another.
-                self.DESC = desc
-            
-            elif(line.split(':')[0][:4] == 'exit'):
-                # We've got an exit.
-                exit_name = line.split(':')[0][5:] # Get the name of the exit.
-                exit_room = line.split(':')[1]     # Get the room to which the exit leads.
-                self.EXITS[exit_name] = exit_room  # Add the exit information to our list.
-        if(LOG_FILE_ACCESS):
-            log('Room loaded: %s.%s' % (self.ID, self.NAME), '>')
+        return '^c^UPlayers^u: %s^~' % (', '.join(players))
     
     
-    def save(self):
-        # Save the room to its file.
-        shortname = '%s.%s.room' % (self.ID, self.NAME)                # Get the filename.
-        longname  = 'world/zones/%s/rooms/%s' % (self.ZONE, shortname) # Get the entire file path.
+    def get_text(self):
+        # Get the contents of the room's save file.
         if(self.SETTINGS == []):
             settings = 'none'
         else:
@@ -131,30 +157,83 @@ class room:
             exit_name = 'exit.%s' % (key)
             exit_room = self.EXITS[key]
             lines.append('%s:%s' % (exit_name, exit_room))
-        
-        # Finally, let's write the file.
-        room_file = open(longname, 'w') # Open the room file.
-        for line in lines:
-            # Write each line.
-            room_file.write('%s\n' % (line))
-        room_file.close() # Close the room file.
+        return ''.join(['%s\n' % (line) for line in lines])
+    
+    
+    def invalidate(self):
+        # Forget the cached description. This must happen whenever DESC or EXITS change.
+        self.HEADER  = None # The description, without the player list.
+        self.WRAPPED = {}   # That description, wrapped, for each screen width.
+    
+    
+    def load(self, data = None):
+        # Load the room from its save file, or from (data), if it's already been read. (See read().)
+        if(data == None):
+            data = read(self.get_filename())
+            if(LOG_FILE_ACCESS):
+                log('Room loaded: %s.%s' % (self.ID, self.NAME), '>')
+        self.SETTINGS = list(data['settings']) # Copy them, so that changing the room doesn't change the data.
+        self.DESC = data['desc']
+        self.EXITS = dict(data['exits'])
+        self.TARGETS = {}         # The exits lead nowhere until resolve() finds their rooms.
+        self.EXIT_NAMES = {}
+        self.EXIT_INDEX = index()
+        self.invalidate() # The room may have changed, so its description needs rebuilding.
+    
+    
+    def resolve(self, rooms):
+        # Point each exit at the room it leads to, from (rooms), a dict of rooms by address. Returns the addresses that weren't found.
+        self.TARGETS = {}
+        self.EXIT_NAMES = {}
+        missing = []
+        for exit_name in sorted(self.EXITS.keys()):
+            if(self.EXITS[exit_name] in rooms):
+                target = rooms[self.EXITS[exit_name]]
+                self.TARGETS[exit_name] = target
+                if(target.ADDRESS not in self.EXIT_NAMES):
+                    # If several exits lead to the same room, the first one alphabetically names the way there.
+                    self.EXIT_NAMES[target.ADDRESS] = exit_name
+            else:
+                missing.append(self.EXITS[exit_name])
+        self.EXIT_INDEX = index(self.TARGETS) # Index the exits, so commands can be matched against them.
+        return missing
+    
+    
+    def save(self):
+        # Save the room to its file. The writer does the writing, in the background.
+        writer.save_file(self.get_filename(), self.get_text())
+        self.DIRTY = False # It's as good as written.
         if(LOG_FILE_ACCESS):
             log('Room saved: %s.%s' % (self.ID, self.NAME), '<')
     
     
     def tick(self):
-        # Update the room.
-        pass
+        # Update the room. Returns whether it still needs ticking.
+        return (self.PLAYERS != {})
+    
+    
+    def wake(self):
+        # Start ticking the room, if it isn't being ticked already. It keeps ticking until tick() says it's gone quiet.
+        if(self.PARENT is not None):
+            self.PARENT.wake_room(self)
     
     
-    def __init__(self, filename):
-        # Initialize the room.
+    def __init__(self, filename, data = None):
+        # Initialize the room, from its file, or from (data) if it's already been read.
         shortname = filename.split('/')[-1] # Get the name of the file itself.
         self.ZONE = filename.split('/')[-3] # Get the name of the zone.
         self.ID   = shortname.split('.')[0] # Get the room ID.
         self.NAME = shortname.split('.')[1] # Get the room name.
+        self.ADDRESS = '%s.%s' % (self.ZONE.split('.')[0], self.ID) # This is how exits and players refer to the room. (zone.room)
+        self.PARENT = None # The zone the room belongs to.
         self.PLAYERS = {}  # This is a list of the player keys currently in the room.
+        self.NAMES = []    # The names of those players, in the order they arrived.
+        self.NAME_INDEX = index() # The same names, indexed, with the keys of the players by each one.
         self.SETTINGS = [] # List of settings.
         self.DESC = ''     # Description of the room.
         self.EXITS = {}    # A dictionary of exits.
-        self.load()        # Load the room from its save file.
\ No newline at end of file
+        self.TARGETS = {}  # The room each exit leads to.
+        self.EXIT_NAMES = {} # The other way around: the name of the exit that leads to each room, by address.
+        self.EXIT_INDEX = index() # The same rooms, indexed by exit name for auto-completion.
+        self.load(data)    # Load the room.
+        self.DIRTY = False # Has it changed since it was loaded or saved?
\ No newline at end of file
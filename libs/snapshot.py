@@ -0,0 +1,81 @@
+""" snapshot.py
+    -----------
+    Snapshots of the whole world, zones, rooms and characters, each kept in one compressed archive.
+    The world forks to take one, so the archive is written from a frozen copy of the game while the
+    game itself carries on. (See world._snapshot().)
+
+    To boot from a snapshot, run 'python miniMUD.py --restore snapshots/<name>.tar.gz'.
+"""
+
+from libs.log import log
+from libs import store
+from cStringIO import StringIO
+import datetime, glob, os, shutil, sqlite3, tarfile, time
+
+DIRECTORY = 'snapshots' # Where snapshots are kept.
+KEEP = 24               # How many snapshots are kept? The oldest are deleted to make room.
+
+def add_file(archive, path, data):
+    # Add a file to an archive, straight from a string.
+    info = tarfile.TarInfo(path)
+    info.size = len(data)
+    info.mtime = time.time()
+    archive.addfile(info, StringIO(data))
+
+def new_path():
+    # Pick the path for a new snapshot. These sort in the order they were taken.
+    return '%s/%s.tar.gz' % (DIRECTORY, timestamp())
+
+def prune():
+    # Delete the oldest snapshots, so that only KEEP of them are left.
+    snapshots = sorted(glob.glob('%s/*.tar.gz' % (DIRECTORY)))
+    for path in snapshots[:-KEEP]:
+        os.remove(path)
+
+def restore(path):
+    # Replace the world's zones and characters with those in a snapshot. The server mustn't be running.
+    # Whatever was replaced is moved aside, into the snapshots directory, rather than deleted.
+    archive = tarfile.open(path, 'r:gz')
+    for member in archive.getmembers():
+        if(not member.isfile() or not member.name.startswith('world/') or '..' in member.name.split('/')):
+            # Nothing in a snapshot should be anywhere but the world directory.
+            raise ValueError('%s is not a snapshot. (It contains %s.)' % (path, member.name))
+    aside = '%s/replaced.%s' % (DIRECTORY, timestamp())
+    os.makedirs(aside)
+    for item in ['world/zones', store.DATABASE, store.DATABASE + '-wal', store.DATABASE + '-shm']:
+        if(os.path.exists(item)):
+            shutil.move(item, '%s/%s' % (aside, os.path.basename(item)))
+    archive.extractall()
+    archive.close()
+    log('Restored the world from %s. What it replaced is in %s.' % (path, aside), '!')
+
+def timestamp():
+    # A timestamp, for naming things after when they happened.
+    return datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+
+def write(path, zones, records):
+    # Write a snapshot of (zones), a dict of zones, and (records), a list of character records, to (path).
+    # This runs in a forked child, so nothing else is changing the world underneath it.
+    if(not os.path.isdir(DIRECTORY)):
+        os.makedirs(DIRECTORY)
+    temporary = '%s.tmp' % (path)
+    archive = tarfile.open(temporary, 'w:gz')
+    for ID in zones.keys():
+        # Each zone, and all of its rooms.
+        add_file(archive, zones[ID].get_filename(), zones[ID].get_text())
+        for rm in zones[ID].ROOMS.values():
+            add_file(archive, rm.get_filename(), rm.get_text())
+    
+    # The characters go in a fresh database of their own, ready to drop in place of the real one.
+    database = '%s.db' % (temporary)
+    connection = sqlite3.connect(database)
+    connection.execute(store.SCHEMA)
+    store.insert(connection, records)
+    connection.commit()
+    connection.close()
+    archive.add(database, store.DATABASE)
+    os.remove(database)
+    
+    archive.close()
+    os.rename(temporary, path) # Only a finished snapshot gets a snapshot's name.
+    prune()
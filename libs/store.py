@@ -0,0 +1,125 @@
+""" store.py
+    --------
+    The player store. Every character is a row in an SQLite database, and the names of all of them are
+    kept in memory, so that checking whether a name is taken never touches the disk. Saving goes through
+    the background writer (see writer.py), which uses its own connection to the database.
+
+    Run 'python -m libs.store' from the MUD's directory to import old .plr files by hand.
+"""
+
+from libs.log import log
+import glob, sqlite3, threading
+
+DATABASE = 'world/players/players.db' # Where the database lives.
+FIELDS = ('name', 'pass', 'role', 'sex', 'room') # The columns, in the order they're stored.
+SCHEMA = 'CREATE TABLE IF NOT EXISTS players (name TEXT PRIMARY KEY, pass TEXT, role INTEGER, sex TEXT, room TEXT)'
+
+CONNECTION = None # The open database.
+NAMES = {}        # The name of every character, in lowercase, with the name as it's stored.
+STAGED = {}       # Characters that have been saved, but not yet written, by lowercase name.
+LOCK = threading.Lock() # Guards STAGED, which the writer thread clears as it goes.
+
+def connect(path = DATABASE):
+    # Open the database, creating it if need be, and index every name in it.
+    global CONNECTION
+    CONNECTION = open_database(path)
+    NAMES.clear()
+    for (name,) in CONNECTION.execute('SELECT name FROM players'):
+        NAMES[name.lower()] = name
+    log('%d characters indexed.' % (len(NAMES)), '>')
+    if(len(NAMES) == 0 and len(glob.glob('world/players/*.plr')) > 0):
+        # A new database, but there are characters from before it existed. Bring them over.
+        import_players()
+
+def count():
+    # How many characters are there?
+    return len(NAMES)
+
+def exists(name):
+    # Is there a character by this name?
+    return name.lower() in NAMES
+
+def import_players(pattern = 'world/players/*.plr'):
+    # Copy old .plr files into the database. Characters already in it are left alone. Returns how many were imported.
+    imported = 0
+    for filename in glob.glob(pattern):
+        record = {}
+        for line in open(filename, 'r').read().split('\n'):
+            # Each line is 'setting:value'.
+            parts = line.split(':')
+            if(parts[0] in FIELDS and len(parts) > 1):
+                record[parts[0]] = parts[1]
+        if('name' not in record or exists(record['name'])):
+            # Either it's not a character, or it's already been imported.
+            continue
+        record['role'] = int(record.get('role', 0))
+        save(record, commit = False)
+        imported = imported + 1
+    CONNECTION.commit()
+    log('%d characters imported.' % (imported), '>')
+    return imported
+
+def insert(connection, records):
+    # Write some characters over (connection), without committing.
+    connection.executemany('INSERT OR REPLACE INTO players (%s) VALUES (?, ?, ?, ?, ?)' % (', '.join(FIELDS)),
+                           [tuple([record.get(field, '') for field in FIELDS]) for record in records])
+
+def load(name):
+    # Read a character, as a dict of FIELDS. None if they don't exist.
+    with LOCK:
+        if(name.lower() in STAGED):
+            # They've been saved since they were last written, so the database is behind.
+            return dict(STAGED[name.lower()])
+    row = CONNECTION.execute('SELECT %s FROM players WHERE name = ?' % (', '.join(FIELDS)), (NAMES.get(name.lower(), name),)).fetchone()
+    if(row == None):
+        return None
+    return dict(zip(FIELDS, row))
+
+def load_all():
+    # Read every character, including any that are waiting to be written. For snapshots, which run in a forked
+    # child: it opens its own connection, and reads STAGED without LOCK, which may have been held by a thread
+    # that didn't survive the fork.
+    connection = open_database()
+    records = {}
+    for row in connection.execute('SELECT %s FROM players' % (', '.join(FIELDS))):
+        records[row[0]] = dict(zip(FIELDS, row))
+    connection.close()
+    for record in STAGED.values():
+        records[record['name']] = record
+    return records
+
+def open_database(path = DATABASE):
+    # Open a connection to the database. Each thread that uses it needs its own.
+    connection = sqlite3.connect(path)
+    connection.text_factory = str # Keep text as plain strings, like everything else in the MUD.
+    connection.execute('PRAGMA journal_mode=WAL') # So that reading a character never waits on the writer.
+    connection.execute(SCHEMA)
+    return connection
+
+def save(record, commit = True):
+    # Write a character right away, given as a dict of FIELDS. It replaces whatever was stored under their name before.
+    # The game saves through the writer instead. This is for importing, before the game has started.
+    write(CONNECTION, [record], commit)
+    NAMES[record['name'].lower()] = record['name']
+
+def stage(record):
+    # Hold on to a character that's waiting to be written, so it can be loaded in the meantime.
+    with LOCK:
+        STAGED[record['name'].lower()] = record
+    NAMES[record['name'].lower()] = record['name']
+
+def write(connection, records, commit = True):
+    # Write some characters over (connection), all in one transaction. Once they're written, they're no longer staged.
+    insert(connection, records)
+    if(commit):
+        connection.commit()
+    with LOCK:
+        for record in records:
+            if(STAGED.get(record['name'].lower()) is record):
+                # Unless it's been saved again since, it's done.
+                del STAGED[record['name'].lower()]
+
+if(__name__ == '__main__'):
+    # Import old .plr files by hand.
+    connect()
+    import_players()
@@ -3,17 +3,28 @@
     This is where the meat of the game-code resides.
 """
 
-from libs import player, zone
+from libs import cache, player, zone, password, snapshot, store, writer
+from libs.index import index
 from libs.log import log
-import time, textwrap, glob
+from collections import deque
+import time, textwrap, glob, heapq, traceback, os, signal, sys, gc, multiprocessing, weakref
 
 class world:
     
     """ Just a few variables. """
     PLAYERS = {}      # A dict of connected players, with addrport() as key.
     ALIVE = True      # Is the server alive?
-    UPDATES = []      # A list of updates to execute in the world.
     TICK_LENGTH = 1.0 # How many seconds per tick?
+    LOGIN_TIMEOUT = 120.0 # How many seconds can someone sit at the login prompts before they're dropped?
+    IDLE_TIMEOUT  = 300.0 # And how many can a player sit idle in the world?
+    UPDATE_BUDGET = 0.05 # How many seconds of commands can run in one pass? Whatever's left waits for the next.
+    PRIORITY = ['reboot', 'shutdown'] # Commands that skip the line, and the budget.
+    LATENCY_REPORT = 300.0 # How many seconds between command latency reports in the log?
+    START_ROOM = '0.0' # Where players go when their room can't be found.
+    HASH_POLL = 0.01   # How often do we check for finished password hashes, while any are being worked on?
+    SAVE_INTERVAL = 60.0 # How many seconds between saves of whatever's changed? This is how much a crash can lose.
+    SNAPSHOT_INTERVAL = 3600.0 # How many seconds between snapshots of the whole world? (See snapshot.py.)
+    ZONE_WORKERS = multiprocessing.cpu_count() # How many processes parse zone files at boot? 1 parses them all in this one.
     
     
     """ Public commands available to characters. """
@@ -35,24 +46,25 @@ class world:
         "'" : 'say',
     }
     
+    PERMISSIONS = {
+        # This is a dict of commands that are restricted, or that force a delay afterwards.
+        # Each is (minimum role, message for those without it, ticks to wait after using it).
+        'broadcast': (2, 'You must be a moderator or admin to broadcast messages.', 3),
+        'reboot'   : (2, 'You must be an admin to reboot the server.',              0),
+        'shutdown' : (2, 'You must be an admin to shutdown the server.',            0),
+        'snapshot' : (2, 'You must be an admin to take a snapshot of the world.',   0),
+    }
+    
     def broadcast(self, key, modifiers):
-        # Broadcast a message to all users of the MUD.
-        if(self.PLAYERS[key].ROLE > 1):
-            # Restrict this command to mods and admins.
-            if(len(modifiers) > 0):
-                # They specified a message to broadcast.
-                message = ' '.join(modifiers) # Compile the list back into a string.
-                for key in self.PLAYERS.keys():
-                    # Send the message to each user.
-                    self.PLAYERS[key].send(message)
-                log('%s broadcast message: %s' % (key, message),'!') # Log about it, since this isn't something to take lightly.
-                self.PLAYERS[key].set_tick_delay(3)                  # Force a 3-tick delay before the next command, to avoid spam.
-            else:
-                # They didn't include a message!
-                self.PLAYERS[key].send('You must specify a message to broadcast!')
+        # Broadcast a message to all users of the MUD. Only admins get this far, and they wait 3 ticks afterwards, to avoid spam. (See PERMISSIONS.)
+        if(len(modifiers) > 0):
+            # They specified a message to broadcast.
+            message = ' '.join(modifiers) # Compile the list back into a string.
+            self._send_all(self.PLAYERS.keys(), message) # Send the message to each user.
+            log('%s broadcast message: %s' % (key, message),'!') # Log about it, since this isn't something to take lightly.
         else:
-            # This person isn't an admin or mod.
-            self.PLAYERS[key].send('You must be a moderator or admin to broadcast messages.')
+            # They didn't include a message!
+            self.PLAYERS[key].send('You must specify a message to broadcast!')
     
     
     def emote(self, key, modifiers):
@@ -62,14 +74,9 @@ class world:
             speaker = self._key2name(key) # Get the name of the speaker.
             self.PLAYERS[key].send('You emote: %s %s' % (speaker, message)) # Tell the speaker what they've emoted.
             # Now we need to get all the keys of all the players in the room.
-            # We start by getting the zone and room ID for the speaking player.
-            (player_zone, player_room) = self._get_zone_and_room(key)
-            # Now that that's taken care of, let's get the player list.
-            players = self.ZONES[player_zone].ROOMS[player_room].PLAYERS.keys()
+            players = self.PLAYERS[key].LOCATION.PLAYERS.keys()
             # Now, let's send them the emote.
-            for player in players:
-                if(player != key):
-                    self.PLAYERS[player].send('%s %s' % (speaker, message))
+            self._send_all([player for player in players if player != key], '%s %s' % (speaker, message))
         else:
             self.PLAYERS[key].send('You must specify something to emote!')
     
@@ -81,40 +88,33 @@ class world:
     
     def look(self, key, modifiers):
         # The player wishes to look at something.
-        (player_zone, player_room) = self._get_zone_and_room(key) # Get the zone and room of the player.
-        output = ''
+        location = self.PLAYERS[key].LOCATION # Get the room the player is in.
+        output = []
         
         # Now we need to figure out what they're looking at.
         if(modifiers == []):
             # They didn't specify a target, so show them the room.
-            output = self.ZONES[player_zone].ROOMS[player_room].get_desc(key)
+            output = location.get_lines(key, self.PLAYERS[key].CLIENT.columns)
         
         # Finally, send them the output.
-        self.PLAYERS[key].send(output)
+        self.PLAYERS[key].send_lines(output)
     
     
     def quit(self, key, modifiers):
         # The user wishes to depart from our fine world.
-        (player_zone, player_room) = self._get_zone_and_room(key) # Get the zone and room of the player.
+        location = self.PLAYERS[key].LOCATION # Get the room the player is in.
         # Now, remove them from the room, then alert the players in the room that they've left.
-        self.ZONES[player_zone].ROOMS[player_room].drop_player(key) # Drop the player from the room.
-        players = self.ZONES[player_zone].ROOMS[player_room].PLAYERS.keys()
-        for player in players:
-            # Now tell each player in the room about the disconnect.
-            self.PLAYERS[player].send('%s fades into the ether.' % (self._key2name(key)))
+        location.drop_player(key) # Drop the player from the room.
+        players = location.PLAYERS.keys()
+        self._send_all(players, '%s fades into the ether.' % (self._key2name(key))) # Now tell each player in the room about the disconnect.
         self.PLAYERS[key].quit() # Disconnect the player.
     
     
     def reboot(self, key, modifiers):
-        # The user wants to reboot the server.
-        if(self.PLAYERS[key].ROLE == 2):
-            # Restrict this command to admins.
-            log('%s issued the command to reboot.' % key, '!')
-            self.ALIVE = 'reboot'
-            self._cleanup()
-        else:
-            # They're not allowed.
-            self.PLAYERS[key].send('You must be an admin to reboot the server.')
+        # The user wants to reboot the server. Only admins get this far. (See PERMISSIONS.)
+        log('%s issued the command to reboot.' % key, '!')
+        self.ALIVE = 'reboot'
+        self._cleanup()
     
     
     def say(self, key, modifiers):
@@ -124,27 +124,23 @@ class world:
             speaker = self._key2name(key) # Get the name of the speaker.
             self.PLAYERS[key].send('You say: %s' % (message)) # Tell the speaker what they've said.
             # Now we need to get all the keys of all the players in the room.
-            # We start by getting the zone and room ID for the speaking player.
-            (player_zone, player_room) = self._get_zone_and_room(key) # Get the zone and room of the player.
-            # Now that that's taken care of, let's get the player list.
-            players = self.ZONES[player_zone].ROOMS[player_room].PLAYERS.keys()
+            players = self.PLAYERS[key].LOCATION.PLAYERS.keys()
             # Now, let's send them the message.
-            for player in players:
-                if(player != key):
-                    self.PLAYERS[player].send('%s says: %s' % (speaker, message))
+            self._send_all([player for player in players if player != key], '%s says: %s' % (speaker, message))
         else:
             self.PLAYERS[key].send('You must specify something to say!')
     
     
     def shutdown(self, key, modifiers):
-        # The user hopes to shut down the server.
-        if(self.PLAYERS[key].ROLE == 2):
-            # Restrict this command to admins.
-            log('%s issued the command to shutdown.' % key, '!')
-            self._cleanup()
-        else:
-            # They're not allowed.
-            self.PLAYERS[key].send('You must be an admin to shutdown the server.')
+        # The user hopes to shut down the server. Only admins get this far. (See PERMISSIONS.)
+        log('%s issued the command to shutdown.' % key, '!')
+        self._cleanup()
+    
+    
+    def snapshot(self, key, modifiers):
+        # The user wants a snapshot of the world taken now. Only admins get this far. (See PERMISSIONS.)
+        log('%s issued the command to take a snapshot.' % key, '!')
+        self._snapshot(key)
     
     
     def tell(self, key, modifiers):
@@ -153,47 +149,25 @@ class world:
             # They didn't do it right.
             self.PLAYERS[key].send('Tell who what?')
         else:
-            speaker_name  = self._key2name(key)           # Get the name of the speaker.
-            listener_name = self._auto_complete(modifiers[0], self._player_list()) # Get the name of the listener.
-            listener_key  = self._name2key(listener_name) # Get the listener's key.
-            message       = ' '.join(modifiers[1:])       # Get the message.
+            speaker_name  = self._key2name(key)              # Get the name of the speaker.
+            listener_name = self.NAMES.complete(modifiers[0]) # Get the name of the listener.
+            listener_key  = self._name2key(listener_name)    # Get the listener's key.
+            message       = ' '.join(modifiers[1:])          # Get the message.
             if(speaker_name == None or listener_name == None or listener_key == None):
                 # Something went wrong.
                 self.PLAYERS[key].send('Could not find that player!')
             else:
                 # Send some messages.
-                for player_key in self.PLAYERS.keys():
-                    if(player_key == key):
-                        # If this is the sender...
-                        self.PLAYERS[player_key].send('You told %s: %s' % (listener_name, message))
-                    else:
-                        # Otherwise...
-                        self.PLAYERS[player_key].send('%s tells you: %s' % (speaker_name, message))
+                self.PLAYERS[key].send('You told %s: %s' % (listener_name, message))          # One to the sender,
+                self.PLAYERS[listener_key].send('%s tells you: %s' % (speaker_name, message)) # and one to the listener.
     
     
     """ Private functions for use by the server. """
     
     def _add_player(self, client):
         # Add a player to the list of connected players.
-        self.PLAYERS[client.addrport()] = player.player(client)
-    
-    
-    def _auto_complete(self, word, word_list):
-        # Take the given (partial) word and find its equal in the word_list.
-        word_length = len(word) # Get the length of the word.
-        word = word.lower()     # Put the word in lowercase.
-        if(word in word_list):
-            # The word is already in the list.
-            return word
-        else:
-            # We need to find out which word closest matches the word provided.
-            word_list.sort()
-            for item in word_list:
-                # Check to see if the word provided could match.
-                if(word == item.lower()[0:len(word)]):
-                    # This word is a match.
-                    return item # Return the item.
-            return None # The item wasn't found.
+        self.PLAYERS[client.addrport()] = player.player(client, self.RESERVED)
+        self._schedule(self.LOGIN_TIMEOUT, self._idle_check(client.addrport(), client)) # Then make sure they don't sit there forever.
     
     
     def _cleanup(self):
@@ -204,21 +178,23 @@ class world:
             doing = 'rebooting'
         else:
             self.ALIVE = False
-        for key in self.PLAYERS.keys(): # Then tell each user, then clean them up.
-            self.PLAYERS[key].send('The server is %s. Please come back soon!' % doing)
+        self._send_all(self.PLAYERS.keys(), 'The server is %s. Please come back soon!' % doing) # Then tell each user,
+        for key in self.PLAYERS.keys(): # then clean them up.
             self.PLAYERS[key].cleanup()
-        for ID in self.ZONES.keys():
-            # Clean up the zones.
-            self.ZONES[ID].cleanup()
+        for ID in self.CHANGED_ZONES.keys():
+            # Clean up the zones. Only those that have changed, or have rooms that have, have anything to do.
+            self.CHANGED_ZONES[ID].cleanup()
+        self.CHANGED_ZONES = {}
+        writer.flush() # Everything that changed is on its way to disk. Wait for it to get there.
     
     
     def _custom_emote(self, key, cmd, modifiers):
         # The user is using a custom emote.
         (aimless, targeted) = self.EMOTES[cmd] # Get the aimless and targeted text for that emote.
         actor_name = self._key2name(key)       # Get the name of the actor.
-        (player_zone, player_room) = self._get_zone_and_room(key) # Get the zone and room of the player.
-        players = self.ZONES[player_zone].ROOMS[player_room].PLAYERS.keys() # Get a list of users in that room.
-        player_names = self.ZONES[player_zone].ROOMS[player_room].PLAYERS.values() # Get a list of user names.
+        location = self.PLAYERS[key].LOCATION  # Get the room the player is in.
+        players = location.PLAYERS.keys()      # Get a list of users in that room.
+        player_names = location.NAME_INDEX     # Get the index of their names.
         
         # Now we need to fix gender-specific wording.
         aimless  = self._fix_gender(aimless,  key)
@@ -226,47 +202,50 @@ class world:
         
         if(len(modifiers) > 0):
             # If there is a target, act accordingly.
-            target_name = self._auto_complete(modifiers[0], player_names)
-            target_key  = self._name2key(target_name)
+            target_name = player_names.complete(modifiers[0])
+            target_key  = player_names.get(target_name)[-1] if(target_name != None) else None # The latest to arrive, if there are two.
             text = targeted.replace('$NAME', actor_name) # Insert the actor name.
             
             # Now send off the message.
             if(target_key in players):
                 # This target exists.
-                for player in players:
-                    if(player == key):
-                        # This is the actor.
-                        out = text.replace('$TARGET', target_name)
-                        self.PLAYERS[player].send('You emote: %s' % (out))
-                    elif(player == target_key):
-                        # This is the target.
-                        out = text.replace('$TARGET', 'you')
-                        out = out.replace("you's", 'your')
-                        out = out.replace('you is', 'you are')
-                        self.PLAYERS[player].send(out)
-                    else:
-                        # This is someone else.
-                        out = text.replace('$TARGET', target_name)
-                        self.PLAYERS[player].send(out)
+                out = text.replace('$TARGET', target_name)
+                self.PLAYERS[key].send('You emote: %s' % (out)) # This is the actor.
+                if(target_key != key):
+                    # This is the target.
+                    out = text.replace('$TARGET', 'you')
+                    out = out.replace("you's", 'your')
+                    out = out.replace('you is', 'you are')
+                    self.PLAYERS[target_key].send(out)
+                # And this is everyone else.
+                self._send_all([player for player in players if player not in (key, target_key)], text.replace('$TARGET', target_name))
             else:
                 # This target does not exist.
                 self.PLAYERS[key].send('You do not see that person here!')
         else:
             # If there's no target designated, use the aimless emote.
             text = aimless.replace('$NAME', actor_name) # Insert the actor name.
-            for player in players:
-                # Send the message to every player.
-                if(player == key):
-                    # This is the actor.
-                    self.PLAYERS[player].send('You emote: %s' % (text))
-                else:
-                    # This is another person in the room.
-                    self.PLAYERS[player].send(text)
+            self.PLAYERS[key].send('You emote: %s' % (text)) # This is the actor.
+            self._send_all([player for player in players if player != key], text) # These are the other people in the room.
     
     
     def _drop_player(self, client):
         # Remove a player from our list of connected clients.
-        del self.PLAYERS[client.addrport()]
+        key = client.addrport()
+        # If they were logged in, take them out of the name index too. Anyone else logged in as the same character stays in it.
+        self.NAMES.detach(self.PLAYERS[key].NAME, key)
+        if(self.PLAYERS[key].LOCATION is not None):
+            # Take them out of their room, so nobody there tries to talk to them. (If they quit, they're already gone.)
+            self.PLAYERS[key].LOCATION.drop_player(key)
+        if(self.PLAYERS[key].STATE != 'logout'):
+            # They lost their link rather than quitting, so save whatever's changed since the last save, as quitting would.
+            self.PLAYERS[key].cleanup()
+        del self.PLAYERS[key]
+    
+    
+    def _emote_handler(self, cmd):
+        # Make a command handler for the custom emote (cmd).
+        return lambda key, modifiers: self._custom_emote(key, cmd, modifiers)
     
     
     def _fix_gender(self, text, key):
@@ -283,251 +262,496 @@ class world:
         return ' '.join(text_out)
     
     
-    def _get_exit_name(self, current, target):
-        # Get the name of an exit from the room.
-        current_zone = current.split('.')[0]
-        current_room = current.split('.')[1]
-        for key in self.ZONES[current_zone].ROOMS[current_room].EXITS:
-            if(self.ZONES[current_zone].ROOMS[current_room].EXITS[key] == target):
-                return key
-        return 'Unknown'
-    
-    
-    def _get_zone_and_room(self, key):
-        # We need to know the room and zone of the player specified.
-        location = self.PLAYERS[key].ROOM # Get the location of the player.
-        zone = location.split('.')[0]     # Extract the zone,
-        room = location.split('.')[1]     # and the room.
-        return (zone, room)               # Then return them both.
-    
-    
     def _key2name(self, key):
         # Get the name of the specified player.
-        try:
+        if(key in self.PLAYERS):
             return self.PLAYERS[key].NAME
-        except:
-            return None
+        return None
     
     
-    def _kick_idle(self):
-        # Check for idle clients, then drop them.
-        for key in self.PLAYERS.keys():
-            # For each player,
-            if(self.PLAYERS[key].CLIENT.idle() > 300):
-                # If it's been idle for more than 5 minutes,
-                self.PLAYERS[key].CLIENT.active = False  # Set it as inactive,
-                log('%s timed out.' % self.PLAYERS[key].ID) # then log about it.
+    def _idle_check(self, key, client):
+        # Make an event that checks whether player (key) has been idle for too long. It only holds a weak reference to
+        # their connection: the socket closes once nothing else refers to it, and that shouldn't wait for the event to come due.
+        connection = weakref.ref(client)
+        return lambda: self._kick_idle(key, connection())
+    
+    
+    def _kick_idle(self, key, client):
+        # Drop player (key) if they've been idle for too long. If they haven't, check again when they might have been.
+        if(client is None or key not in self.PLAYERS or self.PLAYERS[key].CLIENT is not client):
+            # They've already gone.
+            return
+        if(self.PLAYERS[key].STATE == 'live'):
+            deadline = client.last_input_time + self.IDLE_TIMEOUT
+        else:
+            deadline = client.last_input_time + self.LOGIN_TIMEOUT # They haven't finished logging in.
+        now = time.time()
+        if(now >= deadline):
+            # They've been idle too long.
+            client.active = False                       # Set it as inactive,
+            log('%s timed out.' % self.PLAYERS[key].ID) # then log about it.
+        else:
+            # They've done something since this check was scheduled.
+            self._schedule(deadline - now, self._idle_check(key, client))
     
     
     def _loop(self):
-        # This happens repeatedly, at an increment designated by self.TICK_LENGTH.
-        self._kick_idle() # First, get rid of idle players.
+        # Run one pass of the world. The server calls this between polls, and we return how long it may sleep afterwards.
+        self._run_events() # First, run anything that's scheduled to happen by now, like ticks.
         for key in self.PLAYERS.keys():
             # Now we need to check for newly authenticated users.
             if(self.PLAYERS[key].STATE == 'authenticated'):
                 # This player has completed login and needs to be placed in their beginning room.
-                self._move(key, self.PLAYERS[key].ROOM) # Move the player.
+                location = self.ROOMS.get(self.PLAYERS[key].ROOM) # Find the room they were saved in.
+                if(location is None):
+                    # It doesn't exist anymore. Be sure to let the admins know, then start them over.
+                    log('%s (%s) attempted entry into invalid room %s.' % (key, self.PLAYERS[key].NAME, self.PLAYERS[key].ROOM), '!')
+                    location = self.ROOMS[self.START_ROOM]
+                self._move(key, location) # Move the player.
                 self.PLAYERS[key].state_change('live')  # Make them live.
+                self.NAMES.attach(self.PLAYERS[key].NAME, key) # Then index their name, so they can be found.
                 log('%s logged in as %s.' % (key, self.PLAYERS[key].NAME)) # Log about it.
         
         for key in self.PLAYERS.keys():
             # Now, update every player and get their latest action, if applicable.
+            if(key in self.PENDING):
+                # They've already got a command waiting its turn. This keeps everyone taking turns.
+                continue
             update = self.PLAYERS[key].process_input()
             if(update != ''):
                 # If they returned a legitimate action, append it to the list of updates for processing.
-                self.UPDATES.append((key, update))
+                self._queue_update(key, update)
         
         # Next we need to process all updates from all ticks executed thus far.
         self._update() # Get 'er dunn.
         
-        # Finally, we need to see if it's time for another tick.
-        now = time.time() # Get the time.
-        if(now > self.NEXT_TICK):
-            # We're ready.
-            self._tick()
-    
-    
-    def _move(self, key, rm):
-        # Move player or mob (key) to room designation (rm).
-        
-        # First, we determine where they are, and where they're going.
-        current = self.PLAYERS[key].ROOM     # Find out where they are.
-        current_zone = current.split('.')[0] # Then get the zone
-        current_room = current.split('.')[1] # and the room.
-        target_zone = rm.split('.')[0]       # Next, find out where they're going. Zone,
-        target_room = rm.split('.')[1]       # and room.
-        
-        try:
-            # The following tests if the target is a valid room. If this crashes, the target is reset to 0.0.
-            target = self.ZONES[target_zone].ROOMS[target_room].ID
-        except:
-            # Be sure to let the admins know that there was a problem.
-            log('%s (%s) attempted entry into invalid room %s.' % (self.PLAYERS[key].ID, self.PLAYERS[key].NAME, rm), '!')
-            # Then reset the target zone and room.
-            target_zone = '0'
-            target_room = '0'
-            rm = '0.0'
-        
-        try:
-            # Likewise, this performs a sanity check on the current room. If this crashes, the current room is reset to 0.0.
-            target = self.ZONES[current_zone].ROOMS[current_room].ID
-        except:
-            # Let the admins know.
-            log('%s (%s) attempted to exit invalid room %s.' % (self.PLAYERS[key].ID, self.PLAYERS[key].NAME, current), '!')
-            # Then reset the current zone and room.
-            current_zone = '0'
-            current_room = '0'
-            current = '0.0'
-        
-        removed = self.ZONES[current_zone].ROOMS[current_room].drop_player(key) # Remove the player from their current room.
-        if(removed): # This only happens if the player actually existed in the room they were dropped from.
-            # Tell everyone in the room of that player's departure.
-            exit_name = self._get_exit_name(current, rm) # Figure out the name of the exit the player took.
-            for player in self.ZONES[current_zone].ROOMS[current_room].PLAYERS.keys():
-                # For every player still in the room, let them know of the player's movement.
-                self.PLAYERS[player].send('%s departed to the %s.' % (self._key2name(key), exit_name))
+        # If anyone still has work for the next pass, don't sleep at all. Otherwise, sleep until the next event is due.
+        if(len(self.UPDATES) > 0):
+            return 0
+        for key in self.PLAYERS.keys():
+            if(self.PLAYERS[key].busy()):
+                return 0
+        if(password.busy()):
+            # Someone's password is being hashed in the background. Check back shortly for the result.
+            return min(self.HASH_POLL, self._next_event())
+        return self._next_event()
+    
+    
+    def _move(self, key, target):
+        # Move player or mob (key) into room (target).
+        name = self._key2name(key)           # Get the name of who's moving.
+        current = self.PLAYERS[key].LOCATION # Find out where they are. (Nowhere, if they've just logged in.)
+        if(current is not None and current.drop_player(key)):
+            # Remove the player from their current room, then tell everyone there of that player's departure.
+            exit_name = current.EXIT_NAMES.get(target.ADDRESS, 'Unknown') # Figure out the name of the exit the player took.
+            # For every player still in the room, let them know of the player's movement.
+            self._send_all(current.PLAYERS.keys(), '%s departed to the %s.' % (name, exit_name))
         
-        # Now, tell everyone in the new room of that player's arrival.
-        for player in self.ZONES[target_zone].ROOMS[target_room].PLAYERS.keys():
-            # For every player in the new room, let them know of the player's arrival.
-            self.PLAYERS[player].send('%s has arrived.' % (self._key2name(key)))
+        # Now, tell everyone in the new room of that player's arrival, and where from, if there's a way back.
+        if(current is not None and current.ADDRESS in target.EXIT_NAMES):
+            self._send_all(target.PLAYERS.keys(), '%s has arrived from the %s.' % (name, target.EXIT_NAMES[current.ADDRESS]))
+        else:
+            self._send_all(target.PLAYERS.keys(), '%s has arrived.' % (name))
         
-        self.ZONES[target_zone].ROOMS[target_room].add_player(key, self._key2name(key)) # Add the player to the new room.
-        self.PLAYERS[key].ROOM = rm # Set their room to the room they moved to.
+        target.add_player(key, name)            # Add the player to the new room.
+        self.PLAYERS[key].LOCATION = target     # Put them in the room they moved to,
+        if(self.PLAYERS[key].ROOM != target.ADDRESS):
+            self.PLAYERS[key].ROOM = target.ADDRESS # and remember its address, for saving.
+            self.PLAYERS[key].DIRTY = True
         self.look(key,[]) # This will show the user their new surroundings.
     
     
-    def _name2key(self, name):
-        # Get the key of the specified player.
-        for key in self.PLAYERS.keys():
-            if(self.PLAYERS[key].NAME == name):
-                return key
-        return None
+    def _next_event(self):
+        # How many seconds until the next scheduled event? None if nothing is scheduled.
+        if(self.EVENTS == []):
+            return None
+        return max(self.EVENTS[0][0] - time.time(), 0)
     
     
-    def _player_list(self):
-        # Get a list of player names.
-        names = []
-        for key in self.PLAYERS.keys():
-            names.append(self.PLAYERS[key].NAME)
-        return names
+    def _name2key(self, name):
+        # Get the key of the specified player. If they're logged in more than once, it's their latest session.
+        if(name == None or name not in self.NAMES):
+            return None
+        return self.NAMES.get(name)[-1]
+    
+    
+    def _parse_zones(self, folders):
+        # Parse the files of the zones in (folders) that aren't in the boot cache, or have changed, and add them to it.
+        # Zones don't depend on each other until their exits are checked, so each one's files can go to a different worker.
+        # Returns each folder, with a dict of its files and what they parsed into, ready for the zone. Each file is only
+        # looked for and checked against the cache once.
+        started = time.time()
+        found = {}
+        jobs = []
+        for folder in folders:
+            zone_name = folder.split('/')[-2]
+            found[folder] = ['%s%s.nfo' % (folder, zone_name)] + glob.glob('%srooms/*.room' % (folder))
+            stale = cache.stale(found[folder])
+            if(len(stale) > 0):
+                jobs.append((zone_name, stale))
+        if(len(jobs) > 0):
+            self._read_zone_files(jobs)
+            log('Parsed %d zones in %.2f seconds.' % (len(jobs), time.time() - started), '>')
+        files = {}
+        for folder in folders:
+            files[folder] = dict([(path, cache.use(path)) for path in found[folder]])
+        return files
+    
+    
+    def _read_zone_files(self, jobs):
+        # Read the files in (jobs), a list of (zone name, paths), into the boot cache.
+        
+        workers = max(1, min(self.ZONE_WORKERS, len(jobs)))
+        if(workers > 1):
+            # Hand the zones out to a pool of worker processes. What comes back is plain data, ready for the cache.
+            pool = multiprocessing.Pool(workers)
+            results = pool.map(zone.read_files, [paths for (zone_name, paths) in jobs])
+            pool.close()
+            pool.join()
+        else:
+            # Not worth starting any workers.
+            results = [zone.read_files(paths) for (zone_name, paths) in jobs]
+        for i in range(len(jobs)):
+            (entries, seconds, pid) = results[i]
+            for path in entries.keys():
+                cache.add(path, entries[path])
+            log('Zone parsed: %s (%d files in %.2f seconds, by process %d, of %d)' % (jobs[i][0], len(entries), seconds, pid, workers), '>')
     
     
     def _process_update(self, key, command, modifiers):
         # Take a piece of input, then act upon it.
-        cmd = ''
-        
-        # First, we need to get a list of exits available to that player.
-        (player_zone, player_room) = self._get_zone_and_room(key)  # Get the zone and room of the player.
-        exits = self.ZONES[player_zone].ROOMS[player_room].exits() # Get the list of exits for that room.
+        exits = self.PLAYERS[key].LOCATION.EXIT_INDEX # Get the exits available to the player.
+        cmd = self._resolve(key, command)             # Figure out which command they meant.
         
-        if(command in self.SUBSTITUTIONS.keys()):
-            # If the command is in the substitution list, substitute it.
-            cmd = self.SUBSTITUTIONS[command]
-        else:
-            # Otherwise, attempt to auto-complete the command.
-            
-            # Combine all available commands into a single list.
-            available_commands = self.COMMANDS + exits + list(self.EMOTES.keys())
-            # Then we sort the list.
-            available_commands.sort()
-            
-            # Finally, we attempt to auto-complete their partial command based on the list of commands available.
-            cmd = self._auto_complete(command, available_commands)
-        
-        if(cmd):
-            # The command was found in the auto_complete.
+        if(cmd != None and cmd in self.REGISTRY):
+            # It's a command or an emote. Commands win over exits with the same name.
+            (handler, role, refusal, cooldown) = self.REGISTRY.get(cmd)
+            if(self.PLAYERS[key].ROLE < role):
+                # They're not allowed to use it.
+                self.PLAYERS[key].send(refusal)
+                return
             try:
-                # First we attempt to execute it as a function.
-                getattr(self, cmd)(key, modifiers)
-            except:
-                # The command isn't one that's built-in. These require special processing.
-                if(cmd in exits):
-                    # The command they provided is one of the exits. So, move them to that room.
-                    target_room = self.ZONES[player_zone].ROOMS[player_room].EXITS[cmd]
-                    self._move(key, target_room)
-                elif(cmd in self.EMOTES.keys()):
-                    # The command is an emote. Run the emote processor.
-                    self._custom_emote(key, cmd, modifiers)
+                handler(key, modifiers)
+            except Exception:
+                # A command failed. Keep the server up, but let the admins know what happened.
+                log('Command %s from %s failed:\n%s' % (cmd, key, traceback.format_exc()), '!')
+                return
+            if(cooldown > 0 and key in self.PLAYERS):
+                # Force a delay before their next command.
+                self.PLAYERS[key].set_tick_delay(cooldown)
+                self.WAITING[key] = True # Only players with a delay need ticking.
+        elif(cmd != None and cmd in exits):
+            # The command they provided is one of the exits. So, move them to that room.
+            self._move(key, exits.get(cmd))
         else:
             # The command was not found in the auto_complete.
             self.PLAYERS[key].send("I'm sorry, I don't understand the command '%s'." % (command))
     
     
-    def _tick(self):
-        # Execute this once per tick cycle.
+    def _queue_update(self, key, update):
+        # Queue a player's command to be processed. Priority commands go in their own line, ahead of everything else.
+        update = update.strip().split(' ') # Remove extra whitespace.
+        command = update[0]                # The command is the first word they issue.
+        modifiers = update[1:]             # The modifiers are the remaining words they sent.
+        if(self._resolve(key, command) in self.PRIORITY):
+            self.URGENT.append((key, command, modifiers, time.time()))
+        else:
+            self.UPDATES.append((key, command, modifiers, time.time()))
+        self.PENDING[key] = True
+    
+    
+    def _read_emotes(self, filename):
+        # Read the emotes file. Each line is name:aimless emote:targeted emote.
+        emotes = {} # Initialize the empty list.
+        lines = open(filename,'r').read().split('\n') # Read the emotes file into lines.
+        for line in lines:
+            parts = line.split(':')
+            if(len(parts) == 3):
+                # The current line is an emotion definition.
+                emotes[parts[0]] = (parts[1], parts[2]) # Parts[1] is the aimless emote, parts[2] is the targeted emote.
+        return emotes
+    
+    
+    def _reap_snapshot(self):
+        # Check whether the snapshot being taken is done yet. If not, check again in a second.
+        (pid, path, started, key) = self.SNAPSHOT
+        (done, status) = os.waitpid(pid, os.WNOHANG)
+        if(done == 0):
+            # It's still going.
+            self._schedule(1.0, self._reap_snapshot)
+            return
+        self.SNAPSHOT = None
+        if(status == 0):
+            message = 'Snapshot written to %s in %.1f seconds.' % (path, time.time() - started)
+            log(message, '<')
+        else:
+            message = 'Snapshot to %s failed. (See the log.)' % (path)
+            if(os.WIFSIGNALED(status)):
+                log('%s Killed by signal %d.' % (message, os.WTERMSIG(status)), '!')
+            else:
+                log('%s Exit status %d.' % (message, os.WEXITSTATUS(status)), '!')
+        if(key in self.PLAYERS):
+            # Whoever asked for it is still around, so let them know how it went.
+            self.PLAYERS[key].send(message)
+    
+    
+    def _report_latency(self):
+        # Log how long commands have been waiting for their turn.
+        if(self.PROCESSED == 0):
+            # Nothing's happened since the last report.
+            return
+        samples = []
+        slowest = None
         for key in self.PLAYERS.keys():
-            # Update all players.
-            self.PLAYERS[key].tick()
+            samples.extend(self.PLAYERS[key].LATENCY)
+            if(slowest == None or self.PLAYERS[key].latency(0.95) > self.PLAYERS[slowest].latency(0.95)):
+                slowest = key
+        samples.sort()
+        if(samples != []):
+            log('%d commands processed. Latency: %.1fms median, %.1fms 95th percentile, %.1fms 99th percentile. Slowest: %s (%.1fms 95th percentile).' % (
+                self.PROCESSED, player.percentile(samples, 0.5) * 1000, player.percentile(samples, 0.95) * 1000, player.percentile(samples, 0.99) * 1000,
+                self.PLAYERS[slowest].NAME, self.PLAYERS[slowest].latency(0.95) * 1000))
+        self.PROCESSED = 0
+    
+    
+    def _resolve(self, key, command):
+        # Figure out which command (or exit) the player means by (command). None if there isn't one.
+        if(command in self.SUBSTITUTIONS):
+            # If the command is in the substitution list, substitute it.
+            return self.SUBSTITUTIONS[command]
+        # Otherwise, auto-complete it from the registered commands, with the room's exits laid over them.
+        return self.REGISTRY.complete(command, self.PLAYERS[key].LOCATION.EXIT_INDEX)
+    
+    
+    def _run_events(self):
+        # Run every scheduled event that's due.
+        now = time.time()
+        while(self.EVENTS != [] and self.EVENTS[0][0] <= now):
+            (when, order, callback, interval) = heapq.heappop(self.EVENTS)
+            if(interval != None):
+                # It repeats, so put it back on the schedule. If we've fallen a whole interval behind, don't try to catch up.
+                heapq.heappush(self.EVENTS, (max(when + interval, now), order, callback, interval))
+            callback()
+    
+    
+    def _run_update(self, update):
+        # Process a single update, then note how long it waited.
+        (key, command, modifiers, queued) = update
+        del self.PENDING[key] # They can queue another now.
+        if(key not in self.PLAYERS):
+            # They've disconnected since they sent it.
+            return
+        self._process_update(key, command, modifiers) # Now parse and handle the input.
+        if(key in self.PLAYERS):
+            self.PLAYERS[key].LATENCY.append(time.time() - queued)
+        self.PROCESSED = self.PROCESSED + 1
+    
+    
+    def _save(self):
+        # Save whatever's changed since the last save. The writer takes it from here, so this doesn't wait on the disk.
+        for key in self.PLAYERS.keys():
+            if(self.PLAYERS[key].STATE == 'live' and self.PLAYERS[key].DIRTY):
+                self.PLAYERS[key].save()
+        for ID in self.CHANGED_ZONES.keys():
+            self.CHANGED_ZONES[ID].save_changes() # Only the zones that have changed, or have rooms that have.
+        self.CHANGED_ZONES = {}
+    
+    
+    def _schedule(self, delay, callback, interval = None):
+        # Schedule a callback to run in (delay) seconds, then every (interval) seconds after that, if given.
+        self.EVENT_ORDER += 1 # This keeps events that are due at the same moment in the order they were scheduled.
+        heapq.heappush(self.EVENTS, (time.time() + delay, self.EVENT_ORDER, callback, interval))
+    
+    
+    def _send_all(self, keys, message):
+        # Send the same message to many players. It's rendered once for each kind of screen, then shared by everyone with that screen.
+        rendered = {}
+        for key in keys:
+            screen = self.PLAYERS[key].screen()
+            if(screen not in rendered):
+                # Nobody with this screen has been sent the message yet.
+                rendered[screen] = player.render(message, *screen)
+            self.PLAYERS[key].send_rendered(rendered[screen])
+    
+    
+    def _snapshot(self, key = None):
+        # Take a snapshot of the world. A forked child writes it from its own copy of the game, so the game doesn't have
+        # to wait. (key) is whoever asked for it, if anyone.
+        if(self.SNAPSHOT is not None):
+            # One at a time.
+            if(key in self.PLAYERS):
+                self.PLAYERS[key].send('A snapshot is already being taken.')
+            return
+        if(not hasattr(os, 'fork')):
+            # Snapshots are written from a forked copy of the game, and this platform can't fork.
+            self._snapshot_failed(key, 'Snapshots aren\'t available on this platform.')
+            return
+        path = snapshot.new_path()
+        sys.stdout.flush() # Otherwise the child would print whatever the log has buffered all over again.
+        started = time.time()
+        try:
+            pid = os.fork()
+        except OSError as err:
+            # Most likely there isn't the memory for another process right now. Skip this one; the game carries on regardless.
+            self._snapshot_failed(key, 'Unable to fork for a snapshot: %s' % (err))
+            return
+        if(pid == 0):
+            # This is the child. Write the snapshot, then leave without running any of the server's cleanup.
+            signal.signal(signal.SIGINT, signal.SIG_IGN) # Shutting down the server shouldn't cut the snapshot short.
+            status = 1
+            try:
+                if(self.SERVER is not None):
+                    # Let go of the listening socket, so a reboot can take the port while this is still writing,
+                    self.SERVER.close()
+                for player_key in self.PLAYERS.keys():
+                    # and of every connection, so anyone who leaves is hung up on right away.
+                    self.PLAYERS[player_key].CLIENT.sock.close()
+                records = store.load_all() # Every character,
+                for player_key in self.PLAYERS.keys():
+                    # with those who are logged in as they are right now.
+                    if(self.PLAYERS[player_key].STATE == 'live'):
+                        records[self.PLAYERS[player_key].NAME] = self.PLAYERS[player_key].get_record()
+                snapshot.write(path, self.ZONES, records.values())
+                status = 0
+            except Exception:
+                log('Snapshot failed:\n%s' % (traceback.format_exc().rstrip()), '!')
+            sys.stdout.flush()
+            os._exit(status)
         
-        # Now that updates are complete, prepare our next tick.
-        now = time.time()                       # Update the time.
-        diff = now - self.NEXT_TICK             # Get the time passed since NEXT_TICK was last defined.
-        delta = self.TICK_LENGTH - diff         # See how long until our next tick.
-        self.NEXT_TICK = self.NEXT_TICK + delta # Set the next tick.
+        # This is the parent, which gets straight back to the game. Forking was the only time it had to wait.
+        stall = (time.time() - started) * 1000
+        self.SNAPSHOT = (pid, path, started, key)
+        self._schedule(1.0, self._reap_snapshot)
+        log('Taking a snapshot in process %d. The game paused %.1f ms to fork.' % (pid, stall), '<')
+        if(key in self.PLAYERS):
+            self.PLAYERS[key].send('Taking a snapshot. The game paused %.1f ms to fork.' % (stall))
+    
+    
+    def _snapshot_failed(self, key, message):
+        # A snapshot couldn't be started. Let the admins know, and whoever asked for it, if anyone.
+        log(message, '!')
+        if(key in self.PLAYERS):
+            self.PLAYERS[key].send(message)
+    
+    
+    def _tick(self):
+        # Execute this once per tick cycle.
+        for key in self.WAITING.keys():
+            # Update the players waiting out a delay.
+            if(key not in self.PLAYERS or not self.PLAYERS[key].tick()):
+                # They've gone, or they're done waiting.
+                del self.WAITING[key]
+        for ID in self.ACTIVE_ZONES.keys():
+            # Then update the zones that have something going on.
+            if(not self.ACTIVE_ZONES[ID].tick()):
+                # The zone's gone quiet, so stop ticking it until one of its rooms wakes up again.
+                del self.ACTIVE_ZONES[ID]
     
     
     def _update(self):
-        # Process all the updates returned by the tick.
-        updates = self.UPDATES      # We need to clear the list of updates without losing them. So make a copy!
-        self.UPDATES = []           # Then clear the current list of updates.
-        for update in updates:
-            # Process each update individually.
-            (key, cmd) = update          # First let's get the raw command and the key of who sent it.
-            cmd = cmd.strip().split(' ') # Remove extra whitespace.
-            command = cmd[0]             # The command is the first word they issue.
-            modifiers = cmd[1:]          # The modifiers are the remaining words they sent.
-            self._process_update(key, command, modifiers) # Now parse and handle the input.
+        # Process the updates waiting, urgent ones first, until this pass's budget runs out. Whatever's left carries over to the next pass.
+        deadline = time.time() + self.UPDATE_BUDGET
+        while(len(self.URGENT) > 0):
+            # These don't wait, and don't count against the budget.
+            self._run_update(self.URGENT.popleft())
+        done = 0
+        while(len(self.UPDATES) > 0 and (done == 0 or time.time() < deadline)):
+            # Process updates one at a time, in the order they arrived. At least one gets done every pass.
+            self._run_update(self.UPDATES.popleft())
+            done = done + 1
+    
+    
+    def _wake_zone(self, z):
+        # Start ticking zone (z).
+        self.ACTIVE_ZONES[z.ID] = z
+    
+    
+    def _zone_changed(self, z):
+        # Zone (z), or one of its rooms, needs saving.
+        self.CHANGED_ZONES[z.ID] = z
     
     
     def __init__(self):
         # Create the world.
-        self.COMMANDS = []           # This will become the list of commands.
-        self.NEXT_TICK = time.time() # Set the time for the next tick. (In this case, immediately.)
-        for item in dir(self):
-            # Scan every item in the world class.
-            if((item[0] != '_') and hasattr(getattr(self, item), '__call__')):
-                # Find all the public commands, then add them to a list.
-                self.COMMANDS.append(item)
+        self.NAMES = index()         # The name of each player logged in, with the keys of their sessions.
+        self.EVENTS = []             # A heap of scheduled events: (time due, order, callback, repeat interval).
+        self.EVENT_ORDER = 0         # How many events have been scheduled so far.
+        self.UPDATES = deque()       # Commands waiting to be processed, oldest first,
+        self.URGENT = deque()        # and priority commands, which go before them.
+        self.PENDING = {}            # The keys of players with a command in either.
+        self.WAITING = {}            # The keys of players with a tick delay to wait out.
+        self.PROCESSED = 0           # How many commands have been processed since the last latency report.
+        self._schedule(0, self._tick, self.TICK_LENGTH)     # Tick immediately, then every TICK_LENGTH seconds.
+        self._schedule(self.LATENCY_REPORT, self._report_latency, self.LATENCY_REPORT) # And report on command latency.
+        self._schedule(self.SAVE_INTERVAL, self._save, self.SAVE_INTERVAL) # And save whatever's changed.
+        if(hasattr(os, 'fork')):
+            self._schedule(self.SNAPSHOT_INTERVAL, self._snapshot, self.SNAPSHOT_INTERVAL) # And take snapshots, where we can.
+        self.SNAPSHOT = None         # The snapshot being taken, if any: (process ID, path, time started, key of who asked).
+        self.SERVER = None           # The server we're running under, once it's started. (See miniMUD.py.)
+        store.connect()              # Open the player store.
         
-        # Load zones.
+        # Load zones. Whatever hasn't changed since the last boot comes from the boot cache.
+        # Everything loaded here lasts as long as the world, so there's no garbage to collect. Collecting anyway
+        # means sweeping every room again each time a few hundred more are made, which is most of a big world's boot.
+        gc.disable()
+        cache.load()
         self.ZONES = {}
+        self.ACTIVE_ZONES = {} # The zones that need ticking.
+        self.CHANGED_ZONES = {} # And the zones that need saving.
         file_list = glob.glob('world/zones/*.*/') # Get a list of all zone folders.
+        files = self._parse_zones(file_list)       # Parse whatever needs it, in parallel.
         for item in file_list:
             # For each folder found, load that zone.
-            z = zone.zone(item)
-            self.ZONES[z.ID] = z # Append it to the list of zones.
+            z = zone.zone(item, files[item])
+            z.PARENT = self      # Let it know where it belongs,
+            self.ZONES[z.ID] = z # then append it to the list of zones.
+            if(z.DIRTY or len(z.CHANGED_ROOMS) > 0):
+                # It changed while loading, before it could tell us.
+                self._zone_changed(z)
         
-        # Sanity check all rooms and exits.
-        log('Performing sanity check...')
-        rooms = []
-        exits = []
-        # Compile a list of all room designators and all exits from all rooms.
+        # Index every room by its address, then point each exit straight at the room it leads to.
+        self.ROOMS = {}
         for z in self.ZONES.keys():
             for r in self.ZONES[z].ROOMS.keys():
-                # For each room in each zone, append that room's designator to the list of rooms.
-                rooms.append('%s.%s' % (z,r))
-                for item in self.ZONES[z].ROOMS[r].exits():
-                    des = self.ZONES[z].ROOMS[r].EXITS[item]
-                    if(des not in exits):
-                        exits.append(des)
-        # then see if any exist in the exits that aren't in the rooms.
+                self.ROOMS['%s.%s' % (z,r)] = self.ZONES[z].ROOMS[r]
+        
+        # While we're at it, sanity check all the exits.
+        log('Performing sanity check...')
         failures = []
-        for item in exits:
-            if(item not in rooms):
-                failures.append(item)
+        for address in self.ROOMS.keys():
+            for item in self.ROOMS[address].resolve(self.ROOMS):
+                # This exit leads to a room that doesn't exist.
+                if(item not in failures):
+                    failures.append(item)
         if(len(failures) > 0):
             log('Sanity check failed. Undefined rooms:','!')
             log(' '.join(failures), '!')
             self.ALIVE = False
+        elif(self.START_ROOM not in self.ROOMS):
+            log('Sanity check failed. The starting room %s is undefined.' % (self.START_ROOM), '!')
+            self.ALIVE = False
         else:
             log('Sanity check passed!')
         # Now load up our list of custom emotes.
-        self.EMOTES = {} # Initialize the empty list.
-        lines = open('world/text/emotes.txt','r').read().split('\n') # Read the emotes file into lines.
-        for line in lines:
-            parts = line.split(':')
-            if(len(parts) == 3):
-                # The current line is an emotion definition.
-                self.EMOTES[parts[0]] = (parts[1], parts[2]) # Parts[1] is the aimless emote, parts[2] is the targeted emote.
-        log('%d emotes loaded.' % (len(self.EMOTES)),'>')
\ No newline at end of file
+        self.EMOTES = cache.get('world/text/emotes.txt', self._read_emotes)
+        log('%d emotes loaded.' % (len(self.EMOTES)),'>')
+        cache.save() # Everything's been read, so keep what was parsed for next time.
+        gc.enable()
+        
+        # Finally, build the registry of commands. Each is (handler, minimum role, refusal message, cooldown ticks).
+        self.REGISTRY = index()
+        for item in dir(self):
+            # Scan every item in the world class.
+            if((item[0] != '_') and hasattr(getattr(self, item), '__call__')):
+                # Find all the public commands, then register them.
+                (role, refusal, cooldown) = self.PERMISSIONS.get(item, (0, None, 0))
+                self.REGISTRY.add(item, (getattr(self, item), role, refusal, cooldown))
+        for item in self.EMOTES.keys():
+            # Then register the emotes, unless there's a command by that name already.
+            if(item not in self.REGISTRY):
+                self.REGISTRY.add(item, (self._emote_handler(item), 0, None, 0))
+        
+        # Nobody can name their character after a command, an emote, or a shortcut for one.
+        self.RESERVED = index()
+        for item in self.REGISTRY.words() + self.SUBSTITUTIONS.keys() + ['halt']:
+            self.RESERVED.add(item)
\ No newline at end of file
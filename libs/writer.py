@@ -0,0 +1,130 @@
+""" writer.py
+    ---------
+    The background writer. Saving hands a room, zone or character to this thread, and the game carries on
+    while it's written to disk. Whatever piles up while a write is going on goes out together in the
+    next batch, with a single database commit and one sync per directory.
+"""
+
+from libs.log import log
+from libs import store
+import os, threading, traceback, Queue
+
+RETRY_INTERVAL = 10.0 # How many seconds between attempts to write whatever couldn't be written, while nothing else is saved?
+
+QUEUE = Queue.Queue() # Things waiting to be written: ('file', path, text), ('player', record), or ('retry',) to try failures again.
+THREADS = []          # The writer thread, once it's been started.
+FAILED = {}           # Whatever couldn't be written yet: ('file', path) with its text, and ('player', name) with the record.
+                      # It goes out again with every batch until it's written. Only the writer thread changes it.
+
+def flush():
+    # Wait until everything that's been saved so far is on disk, giving anything that failed one more try. For shutting down and rebooting.
+    queue(('retry',))
+    QUEUE.join()
+    if(len(FAILED) > 0):
+        log('Unable to save %s.' % (', '.join(sorted([key[1] for key in FAILED.keys()]))), '!')
+
+def queue(item):
+    # Hand something to the writer thread, starting it the first time it's needed.
+    if(len(THREADS) == 0):
+        thread = threading.Thread(target = work)
+        thread.daemon = True # Shutdown and reboot wait for it with flush(), rather than by joining it.
+        thread.start()
+        THREADS.append(thread)
+    QUEUE.put(item)
+
+def save_file(path, text):
+    # Write (text) to the file at (path), replacing it.
+    queue(('file', path, text))
+
+def save_player(record):
+    # Write a character to the player store. It can be loaded again right away, even before it's written.
+    store.stage(record)
+    queue(('player', record))
+
+def sync_directory(path):
+    # Make sure the renames in a directory are on disk, not just the files.
+    handle = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
+
+def work():
+    # The writer thread. Take everything that's waiting, and write it all in one go, forever.
+    connection = store.open_database() # The database can only be used from the thread that opened it.
+    while(True):
+        items = []
+        try:
+            # Wait for something to do. If anything's failed, don't wait forever: it needs another try.
+            items.append(QUEUE.get(timeout = (RETRY_INTERVAL if len(FAILED) > 0 else None)))
+        except Queue.Empty:
+            pass
+        while(True):
+            # Then gather up whatever else is waiting with it.
+            try:
+                items.append(QUEUE.get_nowait())
+            except Queue.Empty:
+                break
+        files = {}   # The latest text for each file,
+        records = {} # and the latest record for each character. Anything saved twice is only written once.
+        for key in FAILED.keys():
+            # What failed before goes first. Anything queued since is newer, so it replaces it.
+            if(key[0] == 'file'):
+                files[key[1]] = FAILED[key]
+            else:
+                records[key[1]] = FAILED[key]
+        FAILED.clear()
+        for item in items:
+            if(item[0] == 'file'):
+                files[item[1]] = item[2]
+            elif(item[0] == 'player'):
+                records[item[1]['name']] = item[1]
+        
+        # The files and the characters are written separately, so a problem with one doesn't hold up the other.
+        failures = write_files(files)
+        for path in failures:
+            FAILED[('file', path)] = files[path]
+        written = 0
+        if(len(records) > 0):
+            try:
+                store.write(connection, records.values())
+                written = len(records)
+            except Exception:
+                # The characters stay staged, so they still load as saved. Keep them to try again.
+                log('Saving characters failed:\n%s' % (traceback.format_exc().rstrip()), '!')
+                connection.rollback()
+                for name in records.keys():
+                    FAILED[('player', name)] = records[name]
+        if(len(files) > 0 or len(records) > 0):
+            log('Saved %d files and %d characters.' % (len(files) - len(failures), written), '<')
+        for item in items:
+            QUEUE.task_done()
+
+def write_files(files):
+    # Write each file to a temporary file beside it, then rename it into place, so a crash never leaves half a file.
+    # Returns the paths of any files that couldn't be written. The rest are written regardless.
+    directories = {}
+    failures = []
+    for path in files.keys():
+        temporary = '%s.tmp' % (path)
+        try:
+            handle = open(temporary, 'w')
+            try:
+                handle.write(files[path])
+                handle.flush()
+                os.fsync(handle.fileno()) # It has to be on disk before it replaces the old file.
+            finally:
+                handle.close()
+            os.rename(temporary, path)
+        except Exception as err:
+            log('Unable to save %s: %s' % (path, err), '!')
+            failures.append(path)
+            continue
+        directories[os.path.dirname(path) or '.'] = True
+    for path in directories.keys():
+        # One sync per directory covers every rename in it.
+        try:
+            sync_directory(path)
+        except OSError as err:
+            log('Unable to sync %s: %s' % (path, err), '!')
+    return failures
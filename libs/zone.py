@@ -4,67 +4,67 @@
 """
 
 from libs.log import log
-from libs import room
-import glob
+from libs import cache, room, writer
+import glob, os, time
+
+def parse(text):
+    # Parse the contents of a zone's .nfo file into plain data: a dict of its settings and description.
+    data = {'settings': [], 'desc': ''}
+    lines = text.split('\n')
+    i = 0
+    while(i < len(lines)):
+        # Process each line of the nfo file.
+        (setting, colon, value) = lines[i].partition(':')
+        i = i + 1
+        if(setting == 'settings'):
+            # This is a list of settings for the zone.
+            if(value != 'none'):
+                data['settings'] = value.split(',')
+        elif(setting == 'description'):
+            # Grab the zone's description. It ends with ---
+            end = lines.index('---', i)
+            data['desc'] = '\n'.join(lines[i:end])
+            i = end + 1
+    return data
+
+def read(filename):
+    # Read and parse a zone's .nfo file.
+    return parse(open(filename, 'r').read())
+
+def read_files(paths):
+    # Read a batch of a zone's files, its .nfo and .room files alike. Returns a dict of each path's boot cache entry,
+    # and how long it took. The world runs this in worker processes, so it only deals in plain data. (See world._parse_zones().)
+    started = time.time()
+    entries = {}
+    for path in paths:
+        if(path.endswith('.room')):
+            entries[path] = cache.entry(path, room.read)
+        else:
+            entries[path] = cache.entry(path, read)
+    return (entries, time.time() - started, os.getpid())
 
 class zone:
     
-    def cleanup(self):
-        # Shut down and save the zone.
-        self.save()
-        # Next, clean up all the rooms.
-        for ID in self.ROOMS.keys():
-            self.ROOMS[ID].cleanup()
+    def changed(self):
+        # The zone has changed, and needs saving. Anything that changes it should call this.
+        self.DIRTY = True
+        if(self.PARENT is not None):
+            self.PARENT._zone_changed(self)
     
     
-    def load(self):
-        # Load the zone.
-        self.read_nfo()   # Load the zone's nfo file.
-        self.load_rooms() # Load the zone's rooms.
-        log("Zone loaded: %s.%s" % (self.ID, self.NAME), '>')
-    
-    
-    def load_rooms(self):
-        # Load the rooms in the zone.
-        rooms = glob.glob('world/zones/%s.%s/rooms/*.room' % (self.ID, self.NAME)) # Get a list of rooms.
-        for filename in rooms:
-            # Load each room.
-            rm = room.room(filename)         # Create a new room,
-            rm.apply_settings(self.SETTINGS) # apply zone-wide settings,
-            self.ROOMS[rm.ID] = rm           # then append it to the list.
+    def cleanup(self):
+        # Shut down and save the zone, and any of its rooms, if they've changed.
+        self.save_changes()
     
     
-    def read_nfo(self):
-        # Read the zone's nfo file.
+    def get_filename(self):
+        # Get the path of the zone's .nfo file.
         zone_name = '%s.%s' % (self.ID, self.NAME)
-        file_name = '%s.nfo' % (zone_name)
-        path = 'world/zones/%s/%s' % (zone_name, file_name)
-        lines = open(path,'r').read().split('\n')
-        while(len(lines) > 0):
-            # Process each line of the nfo file.
-            line = lines.pop(0)
-            setting = line.split(':')[0]
-            
-            if(setting == 'settings'):
-                # This is a list of settings for the zone.
-                settings = line.split(':')[1]
-                if(settings == 'none'):
-                    self.SETTINGS = []
-                else:
-                    self.SETTINGS = settings.split(',')
-            
-            elif(setting == 'description'):
-                # Grab the zone's description.
-                desc = lines.pop(0)       # Get the first line of the description.
-                line = lines.pop(0)       # Then grab the next line.
-                while(line != '---'):
-                    # We end the description with ---
-                    desc = '%s\n%s' % (desc, line)
-                self.DESC = desc
+        return 'world/zones/%s/%s.nfo' % (zone_name, zone_name)
     
     
-    def save(self):
-        # Save the zone to its .nfo file.
+    def get_text(self):
+        # Get the contents of the zone's .nfo file.
         if(self.SETTINGS == []):
             # If there are no settings, save 'none'.
             settings = 'none'
@@ -81,31 +81,92 @@ class zone:
             '%s' % (self.DESC),
             '---'
         ]
-        
-        # Now that we've formatted our lines, let's write the file.
-        zone_name = '%s.%s' % (self.ID, self.NAME)
-        file_name = '%s.nfo' % (zone_name)
-        path = 'world/zones/%s/%s' % (zone_name, file_name)
-        nfo_file = open(path,'w') # Open the file.
-        for line in lines:
-            # Write each line.
-            nfo_file.write('%s\n' % (line))
-        nfo_file.close() # Close the file.
+        return ''.join(['%s\n' % (line) for line in lines])
+    
+    
+    def load(self, files = None):
+        # Load the zone, from its files, or from (files) if they've already been read. (See __init__().)
+        self.read_nfo(files)   # Load the zone's nfo file.
+        self.load_rooms(files) # Load the zone's rooms.
+        log("Zone loaded: %s.%s" % (self.ID, self.NAME), '>')
+    
+    
+    def load_rooms(self, files = None):
+        # Load the rooms in the zone, from (files) if they've already been read.
+        if(files != None):
+            rooms = [filename for filename in files.keys() if filename.endswith('.room')]
+        else:
+            rooms = glob.glob('world/zones/%s.%s/rooms/*.room' % (self.ID, self.NAME)) # Get a list of rooms.
+        for filename in rooms:
+            # Load each room. Only the files that have changed since the last boot need reading.
+            data = files[filename] if(files != None) else cache.get(filename, room.read)
+            rm = room.room(filename, data)   # Create a new room,
+            rm.apply_settings(self.SETTINGS) # apply zone-wide settings,
+            rm.PARENT = self                 # let it know where it belongs,
+            self.ROOMS[rm.ID] = rm           # then append it to the list.
+    
+    
+    def read_nfo(self, files = None):
+        # Read the zone's nfo file, unless it hasn't changed since the last boot, or it's in (files) already.
+        if(files != None):
+            data = files[self.get_filename()]
+        else:
+            data = cache.get(self.get_filename(), read)
+        self.SETTINGS = list(data['settings']) # Copy them, so that changing the zone doesn't change the data.
+        self.DESC = data['desc']
+    
+    
+    def room_changed(self, rm):
+        # Room (rm) needs saving. If the zone had nothing to save, it does now.
+        if(rm.ID not in self.CHANGED_ROOMS):
+            self.CHANGED_ROOMS[rm.ID] = rm
+            if(self.PARENT is not None):
+                self.PARENT._zone_changed(self)
+    
+    
+    def save(self):
+        # Save the zone to its .nfo file. The writer does the writing, in the background.
+        writer.save_file(self.get_filename(), self.get_text())
+        self.DIRTY = False # It's as good as written.
         log('Zone saved: %s.%s' % (self.ID, self.NAME), '<')
     
     
+    def save_changes(self):
+        # Save the zone if it's changed, and whichever of its rooms have.
+        if(self.DIRTY):
+            self.save()
+        for ID in self.CHANGED_ROOMS.keys():
+            self.CHANGED_ROOMS[ID].cleanup()
+        self.CHANGED_ROOMS = {}
+    
+    
     def tick(self):
-        # Update the zone.
-        for key in self.ROOMS.keys():
-            self.ROOMS[key].tick()
+        # Update the zone. Only rooms that have something going on are ticked. Returns whether any still are.
+        for key in self.ACTIVE_ROOMS.keys():
+            if(not self.ACTIVE_ROOMS[key].tick()):
+                # The room's gone quiet, so stop ticking it until it wakes up again.
+                del self.ACTIVE_ROOMS[key]
+        return (self.ACTIVE_ROOMS != {})
+    
+    
+    def wake_room(self, rm):
+        # Start ticking room (rm). If the zone was quiet, it needs ticking again too.
+        if(rm.ID not in self.ACTIVE_ROOMS):
+            self.ACTIVE_ROOMS[rm.ID] = rm
+            if(self.PARENT is not None):
+                self.PARENT._wake_zone(self)
     
     
-    def __init__(self, path):
-        # Create the zone.
+    def __init__(self, path, files = None):
+        # Create the zone, from its folder at (path). If its files have already been read, (files) has each path, with what it parsed into.
         zone_info = path.split('/')[-2]     # Get the zone name and ID.
         self.NAME = zone_info.split('.')[1] # Grab the name.
         self.ID   = zone_info.split('.')[0] # And the ID.
+        self.PARENT = None # The world the zone belongs to.
         self.ROOMS = {}    # We need a list of rooms.
+        self.ACTIVE_ROOMS = {} # The rooms that need ticking.
+        self.CHANGED_ROOMS = {} # And the rooms that need saving.
         self.SETTINGS = [] # And a place to keep our zone's settings.
         self.DESC = ''     # This is where we keep the zone's description.
-        self.load() # Load the zone.
\ No newline at end of file
+        self.load(files) # Load the zone.
+        self.DIRTY = False # Has it changed since it was loaded or saved?
\ No newline at end of file
@@ -7,7 +7,7 @@
 
 from miniboa import TelnetServer
 from libs.log import log, new_log
-from libs import world
+from libs import world, snapshot
 import signal, sys, os
 
 PORT = 7000 # This is the port on which the server will run.
@@ -25,6 +25,12 @@ for line in tagline:
     log(line,':')
 
 
+""" If we've been asked to, restore the world from a snapshot first. """
+if(len(sys.argv) > 2 and sys.argv[1] == '--restore'):
+    log('Restoring from snapshot %s...' % (sys.argv[2]))
+    snapshot.restore(sys.argv[2])
+
+
 """ Now we need to initialize the world. """
 log('Initializing world...')
 WORLD = world.world()
@@ -36,7 +42,13 @@ def on_connect(client):
     log('%s connected.' % client.addrport(),'+')
 def on_disconnect(client):
     WORLD._drop_player(client)
-    log('%s disconnected.' % client.addrport(), '-')
+    log('%s disconnected. (%d of %d bytes sent and %d of %d received were telnet negotiation.)' % (client.addrport(),
+        client.negotiation_bytes_sent, client.bytes_sent, client.negotiation_bytes_received, client.bytes_received), '-')
+    if(client.compression_ratio() != None):
+        # They used MCCP2, so show what it saved in bandwidth, and what it cost in CPU time.
+        log('%s compressed %d bytes of output to %d (%.0f%%), in %.3f seconds of CPU time.' % (client.addrport(),
+            client.compress_bytes_in, client.compress_bytes_out, client.compression_ratio() * 100, client.compress_time), '-')
+    client.sock.close() # Hang up now, rather than whenever the last reference to the client happens to go.
 
 log('Starting server listening on port %d...' % PORT)
 SERVER = TelnetServer(
@@ -46,6 +58,7 @@ SERVER = TelnetServer(
     on_disconnect = on_disconnect,
     timeout = 0.05
 )
+WORLD.SERVER = SERVER # Snapshots need to let go of the server's sockets.
 
 
 """ Create a signal handler so that ctrl-c doesn't just crash and burn. """
@@ -59,10 +72,15 @@ def signal_handler(signal, frame):
 signal.signal(signal.SIGINT, signal_handler)
 
 
-""" Now, start our loop. """
-while(WORLD.ALIVE == True):
-    SERVER.poll()
-    WORLD._loop()
+""" Now, start our loop. The server calls the world between polls, and sleeps for as long as the world allows. """
+def world_loop():
+    wait = WORLD._loop() # Run the world, and find out how long it can sleep.
+    if(WORLD.ALIVE != True):
+        # The world has shut down or wants a reboot, so stop the server.
+        SERVER.stop()
+    return wait
+if(WORLD.ALIVE == True):
+    SERVER.run(world_loop)
 SERVER.poll() # Poll one last time.
 
 for key in WORLD.PLAYERS.keys():
@@ -73,7 +91,7 @@ for key in WORLD.PLAYERS.keys():
 if(WORLD.ALIVE == 'reboot'):
     # Reboot the server.
     log('Rebooting server...')
-    SERVER = 0 # Release the server so the port isn't taken.
+    SERVER.close() # Release the port, so the new process can take it.
     os.execl(sys.argv[0],'') # Reboot the system.
 else:
     log('Shutdown complete.')
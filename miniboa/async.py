@@ -16,6 +16,7 @@
 Handle Asynchronous Telnet Connections.
 """
 
+import errno
 import socket
 import select
 import sys
@@ -30,6 +31,198 @@ if sys.platform == 'win32':
 else:
     MAX_CONNECTIONS = 1000
 
+## Descriptors held back from the poll()/epoll() connection cap for log files,
+## player files and the like.
+RESERVED_FILENOS = 32
+
+
+def _fileno_limit():
+    """
+    Returns the number of client connections the process' open file limit
+    leaves room for, after raising the soft limit as far as the hard limit
+    allows.  RESERVED_FILENOS are always left over for everything else.
+    """
+    try:
+        import resource
+        limit, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ImportError, ValueError):
+        return MAX_CONNECTIONS
+    if limit != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            limit = hard
+        except (ValueError, resource.error):
+            pass
+    if limit == resource.RLIM_INFINITY:
+        return 65536
+    return max(limit - RESERVED_FILENOS, 0)
+
+
+#--------------------------------------------------------------Poller Backends
+
+## Each backend keeps a registry of file descriptors and the kind of events
+## we want from them.  Every descriptor is watched for reading; write interest
+## is switched on and off by modify() as a client's send_pending flag flips,
+## so the cost of a poll depends on how many sockets are ready rather than
+## how many are connected.
+
+class SelectPoller(object):
+    """
+    Portable backend built on select.select().  Bound by FD_SETSIZE.
+    """
+    def __init__(self):
+        self.max_connections = MAX_CONNECTIONS
+        self.readers = set()
+        self.writers = set()
+
+    def close(self):
+        """Stop watching everything.  select() holds no descriptor of its own."""
+        self.readers.clear()
+        self.writers.clear()
+
+    def register(self, fileno, writable=False):
+        """Start watching a file descriptor."""
+        self.readers.add(fileno)
+        self.modify(fileno, writable)
+
+    def modify(self, fileno, writable):
+        """Turn write interest on or off for a file descriptor."""
+        if writable:
+            self.writers.add(fileno)
+        else:
+            self.writers.discard(fileno)
+
+    def unregister(self, fileno):
+        """Stop watching a file descriptor."""
+        self.readers.discard(fileno)
+        self.writers.discard(fileno)
+
+    def poll(self, timeout):
+        """
+        Wait up to timeout seconds and return a tuple of two lists, the
+        file descriptors ready to read and those ready to write.
+        """
+        try:
+            rlist, slist, elist = select.select(self.readers, self.writers,
+                [], timeout)
+        except select.error, err:
+            if err[0] == errno.EINTR:
+                return [], []
+            raise
+        return rlist, slist
+
+
+class PollPoller(object):
+    """
+    Backend built on select.poll(), for UNIX-like platforms without epoll.
+    """
+    def __init__(self):
+        self.max_connections = _fileno_limit()
+        self._poller = select.poll()
+        self._read = select.POLLIN | select.POLLPRI
+        self._write = select.POLLOUT
+        self._error = select.POLLERR | select.POLLHUP
+
+    def close(self):
+        """Stop watching everything.  poll() holds no descriptor of its own."""
+        self._poller = select.poll()
+
+    def register(self, fileno, writable=False):
+        """Start watching a file descriptor."""
+        self._poller.register(fileno, self._mask(writable))
+
+    def modify(self, fileno, writable):
+        """Turn write interest on or off for a file descriptor."""
+        self._poller.modify(fileno, self._mask(writable))
+
+    def unregister(self, fileno):
+        """Stop watching a file descriptor."""
+        try:
+            self._poller.unregister(fileno)
+        except KeyError:
+            pass
+
+    def poll(self, timeout):
+        """
+        Wait up to timeout seconds and return a tuple of two lists, the
+        file descriptors ready to read and those ready to write.
+        """
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        try:
+            events = self._poller.poll(timeout)
+        except select.error, err:
+            if err[0] == errno.EINTR:
+                return [], []
+            raise
+        return self._split(events)
+
+    def _mask(self, writable):
+        if writable:
+            return self._read | self._write
+        return self._read
+
+    def _split(self, events):
+        ## Errors and hangups are reported as readable so the next recv()
+        ## notices the dead connection and raises BogConnectionLost.
+        rlist = []
+        slist = []
+        for fileno, event in events:
+            if event & (self._read | self._error):
+                rlist.append(fileno)
+            if event & self._write:
+                slist.append(fileno)
+        return rlist, slist
+
+
+class EpollPoller(PollPoller):
+    """
+    Level-triggered backend built on select.epoll(), for Linux.
+    """
+    def __init__(self):
+        self.max_connections = _fileno_limit()
+        self._poller = select.epoll()
+        self._read = select.EPOLLIN | select.EPOLLPRI
+        self._write = select.EPOLLOUT
+        self._error = select.EPOLLERR | select.EPOLLHUP
+
+    def close(self):
+        """Release the epoll descriptor."""
+        self._poller.close()
+
+    def unregister(self, fileno):
+        """Stop watching a file descriptor."""
+        try:
+            self._poller.unregister(fileno)
+        except (IOError, ValueError):
+            pass
+
+    def poll(self, timeout):
+        """
+        Wait up to timeout seconds and return a tuple of two lists, the
+        file descriptors ready to read and those ready to write.
+        """
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self._poller.poll(timeout)
+        except IOError, err:
+            if err.errno == errno.EINTR:
+                return [], []
+            raise
+        return self._split(events)
+
+
+def best_poller():
+    """
+    Returns the most scalable poller backend this platform supports.
+    """
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    if hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
+
 
 #-----------------------------------------------------Dummy Connection Handlers
 
@@ -55,7 +248,7 @@ class TelnetServer(object):
     Poll sockets for new connections and sending/receiving data from clients.
     """
     def __init__(self, port=7777, address='', on_connect=_on_connect,
-            on_disconnect=_on_disconnect, timeout=0.005):
+            on_disconnect=_on_disconnect, timeout=0.005, poller=None):
         """
         Create a new Telnet Server.
 
@@ -74,7 +267,11 @@ class TelnetServer(object):
             to False.
 
         timeout -- amount of time that Poll() will wait from user inport
-            before returning.  Also frees a slice of CPU time.
+            before returning.  Also frees a slice of CPU time.  Under run()
+            this is only used when the loop callback names no deadline.
+
+        poller -- backend used to wait on the sockets, such as EpollPoller()
+            or SelectPoller().  Defaults to the best one the platform offers.
         """
 
         self.port = port
@@ -82,6 +279,10 @@ class TelnetServer(object):
         self.on_connect = on_connect
         self.on_disconnect = on_disconnect
         self.timeout = timeout
+        self.running = False
+        if poller is None:
+            poller = best_poller()
+        self.poller = poller
 
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -94,11 +295,25 @@ class TelnetServer(object):
 
         self.server_socket = server_socket
         self.server_fileno = server_socket.fileno()
+        self.poller.register(self.server_fileno)
 
         ## Dictionary of active clients,
         ## key = file descriptor, value = TelnetClient (see miniboa.telnet)
         self.clients = {}
 
+        ## Clients whose active or send_pending flag flipped since the last
+        ## poll; only these need their poller registration looked at.
+        self.changed = set()
+
+    def close(self):
+        """
+        Close the listening socket and release the poller.  Call this
+        before re-executing the process, so the port is free for the new
+        one however many references to this server remain.
+        """
+        self.poller.close()
+        self.server_socket.close()
+
     def client_count(self):
         """
         Returns the number of active connections.
@@ -111,43 +326,81 @@ class TelnetServer(object):
         """
         return self.clients.values()
 
+    def pending_bytes(self):
+        """
+        Returns the total number of bytes queued for sending to all clients.
+        See each client's bytes_pending for its own backlog.
+        """
+        return sum(client.bytes_pending for client in self.clients.values())
+
 
-    def poll(self):
+    def _client_changed(self, client):
+        """
+        Watcher handed to each client; queues it for a poller update.
+        """
+        self.changed.add(client)
+
+    def run(self, on_loop):
+        """
+        Drive the server and the application from a single loop until
+        stop() is called.
+
+        on_loop -- function called once per pass, before polling.  It does
+            the application's work and returns the number of seconds until
+            it next needs to run, or None to fall back to self.timeout.
+            Incoming data always cuts the wait short, so input is handled
+            as soon as it arrives and an idle server only wakes when the
+            application has something scheduled.
+        """
+        self.running = True
+        while self.running:
+            timeout = on_loop()
+            if self.running:
+                self.poll(timeout)
+
+    def stop(self):
+        """
+        Make run() return once the current pass is finished.
+        """
+        self.running = False
+
+    def poll(self, timeout=None):
         """
         Perform a non-blocking scan of recv and send states on the server
         and client connection sockets.  Process new connection requests,
         read incomming data, and send outgoing data.  Sends and receives may
         be partial.
-        """
-        #print len(self.connections)
-        ## Build a list of connections to test for receive data pending
-        recv_list = [self.server_fileno]    # always add the server
 
-        for client in self.clients.values():
-            if client.active:
-                recv_list.append(client.fileno)
+        timeout -- seconds to wait for activity; defaults to self.timeout.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        ## Bring the poller up to date with clients that changed state
+        changed = self.changed
+        self.changed = set()
+        for client in changed:
+            if self.clients.get(client.fileno) is not client:
+                continue
             ## Delete inactive connections from the dictionary
-            else:
+            if not client.active:
                 #print "-- Lost connection to %s" % client.addrport()
                 #client.sock.close()
+                self.poller.unregister(client.fileno)
                 self.on_disconnect(client)
                 del self.clients[client.fileno]
+                ## Drop the client's link back to the server
+                client.watcher = None
+            else:
+                self.poller.modify(client.fileno, client.send_pending)
 
-
-        ## Build a list of connections that need to send data
-        send_list = []
-        for client in self.clients.values():
-            if client.send_pending:
-                send_list.append(client.fileno)
-
-        ## Get active socket file descriptors from select.select()
+        ## Get active socket file descriptors from the poller
         try:
-            rlist, slist, elist = select.select(recv_list, send_list, [],
-                self.timeout)
+            rlist, slist = self.poller.poll(max(timeout, 0))
 
-        except select.error, err:
-            ## If we can't even use select(), game over man, game over
-            print >> sys.stderr, ("!! FATAL SELECT error '%d:%s'!"
+        except (select.error, IOError), err:
+            ## If we can't even poll, game over man, game over
+            print >> sys.stderr, ("!! FATAL POLL error '%d:%s'!"
                 % (err[0], err[1]))
             sys.exit(1)
 
@@ -167,18 +420,23 @@ class TelnetServer(object):
                     continue
 
                 ## Check for maximum connections
-                if self.client_count() >= MAX_CONNECTIONS:
+                if self.client_count() >= self.poller.max_connections:
                     print '?? Refusing new connection; maximum in use.'
                     sock.close()
                     continue
 
+                ## Sends and receives may be partial; never let one client
+                ## block the loop.
+                sock.setblocking(0)
                 new_client = TelnetClient(sock, addr_tup)
                 #print "++ Opened connection to %s" % new_client.addrport()
                 ## Add the connection to our dictionary and call handler
                 self.clients[new_client.fileno] = new_client
+                self.poller.register(new_client.fileno)
+                new_client.watcher = self._client_changed
                 self.on_connect(new_client)
 
-            else:
+            elif sock_fileno in self.clients:
                 ## Call the connection's recieve method
                 try:
                     self.clients[sock_fileno].socket_recv()
@@ -188,4 +446,5 @@ class TelnetServer(object):
         ## Process sockets with data to send
         for sock_fileno in slist:
             ## Call the connection's send method
-            self.clients[sock_fileno].socket_send()
+            if sock_fileno in self.clients:
+                self.clients[sock_fileno].socket_send()
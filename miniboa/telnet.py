@@ -16,8 +16,12 @@
 Manage one Telnet client connected via a TCP/IP socket.
 """
 
+import errno
 import socket
 import time
+import zlib
+
+from collections import deque
 
 from miniboa.error import BogConnectionLost
 from miniboa.xterm import colorize
@@ -64,6 +68,21 @@ from miniboa.xterm import word_wrap
 
 UNKNOWN = -1
 
+## Small queued chunks are joined into one write of up to this many bytes;
+## larger chunks are written straight from the queue without copying.
+SEND_COALESCE = 16384
+
+## Input lines longer than this are cut short and the rest of the line is
+## thrown away.
+MAX_LINE_LENGTH = 1024
+
+## A client with this many complete lines waiting to be read is flooding us
+## and gets disconnected.
+MAX_QUEUED_LINES = 500
+
+## Errors from a non-blocking socket that only mean "try again later"
+_RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
 #--[ Telnet Commands ]---------------------------------------------------------
 
 SE      = chr(240)      # End of subnegotiation parameters
@@ -94,6 +113,7 @@ SGA     = chr(  3)      # Suppress Go-Ahead
 TTYPE   = chr( 24)      # Terminal Type
 NAWS    = chr( 31)      # Negotiate About Window Size
 LINEMO  = chr( 34)      # Line Mode
+COMPRESS2 = chr( 86)    # MUD Client Compression Protocol v2 (MCCP2)
 
 
 #-----------------------------------------------------------------Telnet Option
@@ -120,6 +140,7 @@ class TelnetClient(object):
     """
 
     def __init__(self, sock, addr_tup):
+        self.watcher = None         # Called when active or send_pending flip
         self.protocol = 'telnet'
         self.active = True          # Turns False when the connection is lost
         self.sock = sock            # The connection's socket
@@ -131,12 +152,27 @@ class TelnetClient(object):
         self.columns = 80
         self.rows = 24
         self.send_pending = False
-        self.send_buffer = ''
+        self.send_queue = deque()   # Outgoing chunks, oldest first
+        self.send_offset = 0        # Bytes of send_queue[0] already sent
+        self.send_joined = False    # Is send_queue[0] a run we joined?
+        self.bytes_pending = 0      # Bytes queued but not yet sent
         self.recv_buffer = ''
+        self.recv_scan = 0          # Bytes of recv_buffer known to hold no LF
+        self.recv_discard = False   # Dropping the tail of an overlong line?
+        self.max_line_length = MAX_LINE_LENGTH
+        self.max_queued_lines = MAX_QUEUED_LINES
+        self.lines_truncated = 0
+        self.compressor = None      # zlib stream once MCCP2 is running
+        self.compress_unflushed = False # Data compressed but not flushed?
+        self.compress_bytes_in = 0  # Bytes fed to the compressor
+        self.compress_bytes_out = 0 # Compressed bytes it produced
+        self.compress_time = 0.0    # CPU seconds spent compressing
         self.bytes_sent = 0
         self.bytes_received = 0
+        self.negotiation_bytes_sent = 0     # Telnet option negotiation,
+        self.negotiation_bytes_received = 0 # counted before compression
         self.cmd_ready = False
-        self.command_list = []
+        self.command_list = deque()
         self.connect_time = time.time()
         self.last_input_time = time.time()
 
@@ -154,6 +190,31 @@ class TelnetClient(object):
 #        print "Telnet destructor called"
 #        pass
 
+    ## The server only re-examines a client's socket registration when one
+    ## of these two flags changes, so both report their flips to the watcher.
+
+    def _get_active(self):
+        return self._active
+
+    def _set_active(self, state):
+        changed = state != getattr(self, '_active', None)
+        self._active = state
+        if changed and self.watcher:
+            self.watcher(self)
+
+    active = property(_get_active, _set_active)
+
+    def _get_send_pending(self):
+        return self._send_pending
+
+    def _set_send_pending(self, state):
+        changed = state != getattr(self, '_send_pending', None)
+        self._send_pending = state
+        if changed and self.watcher:
+            self.watcher(self)
+
+    send_pending = property(_get_send_pending, _set_send_pending)
+
     def get_command(self):
         """
         Get a line of text that was received from the DE. The class's
@@ -162,7 +223,7 @@ class TelnetClient(object):
         cmd = None
         count = len(self.command_list)
         if count > 0:
-            cmd = self.command_list.pop(0)
+            cmd = self.command_list.popleft()
         ## If that was the last line, turn off lines_pending
         if count == 1:
             self.cmd_ready = False
@@ -173,8 +234,57 @@ class TelnetClient(object):
         Send raw text to the distant end.
         """
         if text:
-            self.send_buffer += text.replace('\n', '\r\n')
-            self.send_pending = True
+            self._queue(text.replace('\n', '\r\n'))
+
+    def send_raw(self, data):
+        """
+        Send text that is already wire-ready: caret codes converted and
+        line endings CR/LF.  The same string can be handed to any number of
+        clients without being copied or converted again.
+        """
+        if data:
+            self._queue(data)
+
+    def _queue(self, data):
+        """
+        Add a chunk of wire-ready data to the outgoing queue, compressing
+        it if MCCP2 is running.
+        """
+        if self.compressor:
+            self.compress_bytes_in += len(data)
+            start = time.clock()
+            data = self.compressor.compress(data)
+            self.compress_time += time.clock() - start
+            self.compress_bytes_out += len(data)
+            self.compress_unflushed = True
+        if data:
+            self.send_queue.append(data)
+            self.bytes_pending += len(data)
+        self.send_pending = True
+
+    def _flush_compressor(self, mode=zlib.Z_SYNC_FLUSH):
+        """
+        Push everything compressed so far onto the outgoing queue.  Run
+        once per send rather than once per message, so that all the output
+        of a pass through the world shares one flush.
+        """
+        start = time.clock()
+        data = self.compressor.flush(mode)
+        self.compress_time += time.clock() - start
+        self.compress_unflushed = False
+        if data:
+            self.compress_bytes_out += len(data)
+            self.send_queue.append(data)
+            self.bytes_pending += len(data)
+
+    def compression_ratio(self):
+        """
+        Returns compressed bytes sent per byte of output, or None if
+        MCCP2 has not compressed anything yet.
+        """
+        if not self.compress_bytes_in:
+            return None
+        return float(self.compress_bytes_out) / self.compress_bytes_in
 
     def send_cc(self, text):
         """
@@ -253,6 +363,19 @@ class TelnetClient(object):
         self._iac_wont(ECHO)
         self._note_reply_pending(ECHO, True)
 
+    def request_handshake(self):
+        """
+        Start the usual negotiations in a single write when the DE first
+        connects: ask for its window size (NAWS) and terminal type, and
+        offer MCCP2 compression.  After this the DE reports window size
+        changes by itself, so nothing needs to be asked again.
+        """
+        self._negotiate('%c%c%c%c%c%c%c%c%c' % (IAC, DO, NAWS, IAC, DO, TTYPE,
+            IAC, WILL, COMPRESS2))
+        self._note_reply_pending(NAWS, True)
+        self._note_reply_pending(TTYPE, True)
+        self._note_reply_pending(COMPRESS2, True)
+
     def request_naws(self):
         """
         Request to Negotiate About Window Size.  See RFC 1073.
@@ -260,6 +383,30 @@ class TelnetClient(object):
         self._iac_do(NAWS)
         self._note_reply_pending(NAWS, True)
 
+    def request_compress2(self):
+        """
+        Offer to compress our output with MCCP2.  Compression starts once
+        the DE agrees with IAC DO COMPRESS2.
+        """
+        self._iac_will(COMPRESS2)
+        self._note_reply_pending(COMPRESS2, True)
+
+    def _start_compress2(self):
+        """
+        Send the uncompressed IAC SB COMPRESS2 IAC SE marker; everything
+        after it goes through a zlib stream kept for the whole connection.
+        """
+        self._negotiate('%c%c%c%c%c' % (IAC, SB, COMPRESS2, IAC, SE))
+        self.compressor = zlib.compressobj()
+
+    def _stop_compress2(self):
+        """
+        End the zlib stream and go back to sending plain data.
+        """
+        if self.compressor:
+            self._flush_compressor(zlib.Z_FINISH)
+            self.compressor = None
+
     def request_terminal_type(self):
         """
         Begins the Telnet negotiations to request the terminal type from
@@ -272,17 +419,49 @@ class TelnetClient(object):
         """
         Called by TelnetServer when send data is ready.
         """
-        if len(self.send_buffer):
+        if self.compress_unflushed:
+            self._flush_compressor()
+        queue = self.send_queue
+        if queue:
+            chunk = queue[0]
+            offset = self.send_offset
+            ## Gather a run of small chunks into a single write.  A large
+            ## chunk ends the run and is sent from the queue as it is, and
+            ## a run that's already been joined is never joined again, so
+            ## no byte is copied twice.
+            if (not self.send_joined and len(queue) > 1
+                    and len(chunk) - offset < SEND_COALESCE
+                    and len(queue[1]) < SEND_COALESCE):
+                parts = [chunk[offset:]]
+                size = len(parts[0])
+                queue.popleft()
+                while (queue and size < SEND_COALESCE
+                        and len(queue[0]) < SEND_COALESCE):
+                    size += len(queue[0])
+                    parts.append(queue.popleft())
+                chunk = ''.join(parts)
+                queue.appendleft(chunk)
+                offset = 0
+                self.send_joined = True
             try:
-                sent = self.sock.send(self.send_buffer)
+                sent = self.sock.send(buffer(chunk, offset))
             except socket.error, err:
+                if err[0] in _RETRY_ERRNOS:
+                    return
                 print("!! SEND error '%d:%s' from %s" % (err[0], err[1],
                     self.addrport()))
                 self.active = False
                 return
             self.bytes_sent += sent
-            self.send_buffer = self.send_buffer[sent:]
-        else:
+            self.bytes_pending -= sent
+            offset += sent
+            ## Trim by offset; the chunk itself is dropped once fully sent
+            if offset >= len(chunk):
+                queue.popleft()
+                offset = 0
+                self.send_joined = False
+            self.send_offset = offset
+        if not queue:
             self.send_pending = False
 
     def socket_recv(self):
@@ -292,6 +471,8 @@ class TelnetClient(object):
         try:
             data = self.sock.recv(2048)
         except socket.error, ex:
+            if ex[0] in _RETRY_ERRNOS:
+                return
             print ("?? socket.recv() error '%d:%s' from %s" %
                 (ex[0], ex[1], self.addrport()))
             raise BogConnectionLost()
@@ -306,20 +487,62 @@ class TelnetClient(object):
         self.bytes_received += size
 
         ## Test for telnet commands
-        for byte in data:
-            self._iac_sniffer(byte)
+        self._scan(data)
 
         ## Look for newline characters to get whole lines from the buffer
+        self._frame_lines()
+
+    def _frame_lines(self):
+        """
+        Move complete lines from recv_buffer to command_list.  Only the
+        part of the buffer that arrived since the last call is searched,
+        and the buffer is trimmed once per call rather than once per line.
+        """
+        buff = self.recv_buffer
+        start = 0
         while True:
-            mark = self.recv_buffer.find('\n')
+            mark = buff.find('\n', max(self.recv_scan, start))
             if mark == -1:
                 break
-            cmd = self.recv_buffer[:mark].strip()
-            self.command_list.append(cmd)
-            self.cmd_ready = True
-            self.recv_buffer = self.recv_buffer[mark+1:]
-
-    def _recv_byte(self, byte):
+            if self.recv_discard:
+                ## The end of a line we already cut short
+                self.recv_discard = False
+            elif mark - start > self.max_line_length:
+                ## A whole overlong line arrived at once; cut it short too
+                self.lines_truncated += 1
+                self._add_line(buff[start:start + self.max_line_length])
+            else:
+                self._add_line(buff[start:mark])
+            start = mark + 1
+            if not self.active:
+                return
+        if start:
+            buff = buff[start:]
+
+        if self.recv_discard:
+            buff = ''
+        elif len(buff) > self.max_line_length:
+            ## Hand over what fits and ignore the rest until the next LF
+            self.lines_truncated += 1
+            self.recv_discard = True
+            self._add_line(buff[:self.max_line_length])
+            buff = ''
+        self.recv_buffer = buff
+        self.recv_scan = len(buff)
+
+    def _add_line(self, line):
+        """
+        Queue a line of input, disconnecting clients that flood us.
+        """
+        if len(self.command_list) >= self.max_queued_lines:
+            print ("?? Input flood from %s, disconnecting." %
+                self.addrport())
+            self.deactivate()
+            return
+        self.command_list.append(line.strip())
+        self.cmd_ready = True
+
+    def _recv_text(self, text):
         """
         Non-printable filtering currently disabled because it did not play
         well with extended character sets.
@@ -327,25 +550,72 @@ class TelnetClient(object):
         ## Filter out non-printing characters
         #if (byte >= ' ' and byte <= '~') or byte == '\n':
         if self.telnet_echo:
-            self._echo_byte(byte)
-        self.recv_buffer += byte
+            self._echo_text(text)
+        self.recv_buffer += text
 
-    def _echo_byte(self, byte):
+    def _echo_text(self, text):
         """
-        Echo a character back to the client and convert LF into CR\LF.
+        Echo characters back to the client and convert LF into CR\LF.
         """
-        if byte == '\n':
-            self.send_buffer += '\r'
         if self.telnet_echo_password:
-            self.send_buffer += '*'
+            self._queue('\r*'.join('*' * len(part)
+                for part in text.split('\n')))
         else:
-            self.send_buffer += byte
+            self._queue(text.replace('\n', '\r\n'))
+
+    def _scan(self, data):
+        """
+        Feed a chunk of received data through the IAC state machine.
+
+        Runs of plain text are located with find() and passed on as one
+        slice; only the bytes that make up IAC sequences are stepped through
+        _iac_sniffer() one at a time.  The result is identical to feeding
+        every byte to _iac_sniffer().
+        """
+        pos = 0
+        size = len(data)
+        text = 0
+        while pos < size:
+
+            ## Finish any IAC sequence in progress a byte at a time
+            if self.telnet_got_iac:
+                self._iac_sniffer(data[pos])
+                pos += 1
+                continue
+
+            mark = data.find(IAC, pos)
+            if mark == -1:
+                mark = size
+
+            if mark > pos:
+                if self.telnet_got_sb:
+                    ## Sub-negotiation payload; the same 64 byte sanity check
+                    ## applies, and the byte that trips it is thrown away.
+                    room = max(64 - len(self.telnet_sb_buffer), 0)
+                    if mark - pos <= room:
+                        self.telnet_sb_buffer += data[pos:mark]
+                    else:
+                        self.telnet_sb_buffer = ''
+                        self.telnet_got_sb = False
+                        pos += room + 1
+                        continue
+                else:
+                    ## Just normal NVT characters
+                    self._recv_text(data[pos:mark])
+                    text += mark - pos
+
+            if mark < size:
+                self.telnet_got_iac = True
+            pos = mark + 1
+
+        ## Everything else was negotiation
+        self.negotiation_bytes_received += size - text
 
     def _iac_sniffer(self, byte):
         """
         Watches incomming data for Telnet IAC sequences.
         Passes the data, if any, with the IAC commands stripped to
-        _recv_byte().
+        _recv_text().
         """
         ## Are we not currently in an IAC sequence coming from the DE?
         if self.telnet_got_iac is False:
@@ -367,7 +637,7 @@ class TelnetClient(object):
 
             else:
                 ## Just a normal NVT character
-                self._recv_byte(byte)
+                self._recv_text(byte)
                 return
 
         ## Byte handling when already in an IAC sequence sent from the DE
@@ -507,6 +777,19 @@ class TelnetClient(object):
                     self._iac_will(SGA)
                     ## Just nod
 
+            elif option == COMPRESS2:
+
+                if self._check_reply_pending(COMPRESS2):
+                    self._note_reply_pending(COMPRESS2, False)
+                    self._note_local_option(COMPRESS2, True)
+                    self._start_compress2()
+
+                elif (self._check_local_option(COMPRESS2) is False or
+                        self._check_local_option(COMPRESS2) is UNKNOWN):
+                    self._note_local_option(COMPRESS2, True)
+                    self._iac_will(COMPRESS2)
+                    self._start_compress2()
+
             else:
 
                 ## ALL OTHER OTHERS = Default to refusing once
@@ -556,6 +839,16 @@ class TelnetClient(object):
                     self._iac_will(SGA)
                     ## Just nod
 
+            elif option == COMPRESS2:
+
+                if self._check_reply_pending(COMPRESS2):
+                    self._note_reply_pending(COMPRESS2, False)
+                    self._note_local_option(COMPRESS2, False)
+
+                elif self._check_local_option(COMPRESS2) is True:
+                    self._note_local_option(COMPRESS2, False)
+                    self._stop_compress2()
+
             else:
 
                 ## ALL OTHER OPTIONS = Default to ignoring
@@ -607,7 +900,7 @@ class TelnetClient(object):
                     self._note_reply_pending(TTYPE, False)
                     self._note_remote_option(TTYPE, True)
                     ## Tell them to send their terminal type
-                    self.send('%c%c%c%c%c%c' % (IAC, SB, TTYPE, SEND, IAC, SE))
+                    self._negotiate('%c%c%c%c%c%c' % (IAC, SB, TTYPE, SEND, IAC, SE))
 
                 elif (self._check_remote_option(TTYPE) is False or
                         self._check_remote_option(TTYPE) is UNKNOWN):
@@ -637,6 +930,19 @@ class TelnetClient(object):
                     self._note_remote_option(SGA, False)
                     self._iac_dont(SGA)
 
+            elif option == NAWS:
+
+                ## DE can't report its window size; keep the defaults
+                if self._check_reply_pending(NAWS):
+                    self._note_reply_pending(NAWS, False)
+                    self._note_remote_option(NAWS, False)
+
+                elif self._check_remote_option(NAWS) is True:
+                    self._note_remote_option(NAWS, False)
+                    self._iac_dont(NAWS)
+
+            elif option == TTYPE:
+
                 if self._check_reply_pending(TTYPE):
                     self._note_reply_pending(TTYPE, False)
                     self._note_remote_option(TTYPE, False)
@@ -720,18 +1026,23 @@ class TelnetClient(object):
 
     #---[ Telnet Command Shortcuts ]-------------------------------------------
 
+    def _negotiate(self, data):
+        """Send Telnet negotiation bytes, counting them."""
+        self.negotiation_bytes_sent += len(data)
+        self._queue(data)
+
     def _iac_do(self, option):
         """Send a Telnet IAC "DO" sequence."""
-        self.send('%c%c%c' % (IAC, DO, option))
+        self._negotiate('%c%c%c' % (IAC, DO, option))
 
     def _iac_dont(self, option):
         """Send a Telnet IAC "DONT" sequence."""
-        self.send('%c%c%c' % (IAC, DONT, option))
+        self._negotiate('%c%c%c' % (IAC, DONT, option))
 
     def _iac_will(self, option):
         """Send a Telnet IAC "WILL" sequence."""
-        self.send('%c%c%c' % (IAC, WILL, option))
+        self._negotiate('%c%c%c' % (IAC, WILL, option))
 
     def _iac_wont(self, option):
         """Send a Telnet IAC "WONT" sequence."""
-        self.send('%c%c%c' % (IAC, WONT, option))
+        self._negotiate('%c%c%c' % (IAC, WONT, option))
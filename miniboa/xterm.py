@@ -60,15 +60,48 @@ _ANSI_CODES = (
     )
 
 
+#--[ Single Pass Translation ]-------------------------------------------------
+
+## Every caret code is a caret and one character, so one regex finds them all
+## (and the ^^ escape) and a dict supplies the replacement.
+_CARET_CODE = re.compile(r'\^[\^%s]' %
+    re.escape(''.join(token[1] for token, code in _ANSI_CODES)))
+
+_TO_ANSI = dict(_ANSI_CODES)
+_TO_ANSI['^^'] = '^'
+_TO_PLAIN = dict((token, '') for token, code in _ANSI_CODES)
+_TO_PLAIN['^^'] = '^'
+
+## Results for recently seen strings, such as room headers and prompts.
+## Each cache is simply emptied when it fills up.
+_CACHE_SIZE = 1024
+_CACHE_MAX_LENGTH = 4096
+_ANSI_CACHE = {}
+_PLAIN_CACHE = {}
+
+
+def _translate(text, table, cache):
+    """
+    Replace every caret code in text using table, remembering the result.
+    """
+    result = cache.get(text)
+    if result is None:
+        if '^' in text:
+            result = _CARET_CODE.sub(lambda match: table[match.group()], text)
+        else:
+            result = text
+        if len(text) <= _CACHE_MAX_LENGTH:
+            if len(cache) >= _CACHE_SIZE:
+                cache.clear()
+            cache[text] = result
+    return result
+
+
 def strip_caret_codes(text):
     """
     Strip out any caret codes from a string.
     """
-    ## temporarily escape out ^^
-    text = text.replace('^^', '\x00')
-    for token, foo in _ANSI_CODES:
-        text = text.replace(token, '')
-    return text.replace('\x00', '^')
+    return _translate(text, _TO_PLAIN, _PLAIN_CACHE)
 
 
 def colorize(text, ansi=True):
@@ -77,13 +110,8 @@ def colorize(text, ansi=True):
     otherwise, simply strip them out.
     """
     if ansi:
-        text = text.replace('^^', '\x00')
-        for token, code in _ANSI_CODES:
-            text = text.replace(token, code)
-        text = text.replace('\x00', '^')
-    else:
-        text = strip_caret_codes(text)
-    return text
+        return _translate(text, _TO_ANSI, _ANSI_CACHE)
+    return strip_caret_codes(text)
 
 
 def word_wrap(text, columns=80, indent=4, padding=2):
@@ -0,0 +1,116 @@
+""" test_telnet.py
+    --------------
+    Checks that TelnetClient._scan(), which finds IAC bytes with find() and passes text on in runs, behaves
+    exactly like the byte-at-a-time parser it replaced. Run 'python -m unittest discover tests' from the
+    MUD's directory.
+"""
+
+from miniboa.telnet import *
+from miniboa.telnet import TelnetClient
+from cStringIO import StringIO
+import random, socket, sys, unittest
+
+class byte_parser(TelnetClient):
+    """ The old parser: every byte goes through _iac_sniffer(), and text is echoed a byte at a time. """
+
+    def _recv_text(self, byte):
+        # The old _recv_byte().
+        if self.telnet_echo:
+            if byte == '\n':
+                self._queue('\r')
+            if self.telnet_echo_password:
+                self._queue('*')
+            else:
+                self._queue(byte)
+        self.recv_buffer += byte
+
+    def _scan(self, data):
+        # The old loop in socket_recv().
+        for byte in data:
+            self._iac_sniffer(byte)
+
+def random_stream(rand):
+    # Make up a stream of text mixed with telnet commands, subnegotiations (some too long), and escaped IACs.
+    options = [BINARY, ECHO, SGA, TTYPE, NAWS, LINEMO, COMPRESS2, chr(200)]
+    pieces = []
+    for i in range(rand.randint(1, 40)):
+        kind = rand.randint(0, 7)
+        if(kind == 0):
+            pieces.append(''.join(rand.choice('abc xyz\r\n\x00') for j in range(rand.randint(1, 30))))
+        elif(kind == 1):
+            pieces.append(IAC + rand.choice([DO, DONT, WILL, WONT]) + rand.choice(options))
+        elif(kind == 2):
+            pieces.append(IAC + rand.choice([NOP, GA, AYT, EC, EL, DATMK, BREAK, IP, AO, SE]))
+        elif(kind == 3):
+            # A subnegotiation, possibly with escaped IACs in it.
+            payload = ''.join(rand.choice(['a', '\x00', '\x50', IAC + IAC]) for j in range(rand.randint(0, 10)))
+            pieces.append(IAC + SB + rand.choice(options) + payload + IAC + SE)
+        elif(kind == 4):
+            # A subnegotiation past the 64 byte sanity limit.
+            pieces.append(IAC + SB + rand.choice(options) + 'q' * rand.randint(60, 200) + IAC + SE)
+        elif(kind == 5):
+            # Window size and terminal type reports.
+            pieces.append(IAC + SB + NAWS + ''.join(chr(rand.randint(0, 255)) for j in range(4)) + IAC + SE)
+            pieces.append(IAC + SB + TTYPE + IS + 'XTERM' + IAC + SE)
+        elif(kind == 6):
+            pieces.append(IAC + IAC)
+        else:
+            # Anything at all.
+            pieces.append(''.join(chr(rand.randint(0, 255)) for j in range(rand.randint(1, 12))))
+    return ''.join(pieces)
+
+def split(rand, data):
+    # Cut a stream into random chunks, so that sequences get split between reads.
+    chunks = []
+    while(data != ''):
+        size = rand.randint(1, 16)
+        chunks.append(data[:size])
+        data = data[size:]
+    return chunks
+
+def state(client):
+    # Everything the parser can affect: lines, buffers, options, replies and what was learned from the client.
+    if(client.compress_unflushed):
+        client._flush_compressor()
+    options = dict((ord(key), (value.local_option, value.remote_option, value.reply_pending)) for (key, value) in client.telnet_opt_dict.items())
+    return (list(client.command_list), client.recv_buffer, client.telnet_got_iac, client.telnet_got_cmd, client.telnet_got_sb,
+            client.telnet_sb_buffer, options, ''.join(client.send_queue), client.columns, client.rows, client.terminal_type,
+            client.compressor is not None, client.active)
+
+class scan_test(unittest.TestCase):
+
+    def run_both(self, seed):
+        # Feed the same stream through both parsers, in the same chunks, and compare where they end up.
+        rand = random.Random(seed)
+        clients = []
+        sockets = []
+        for parser in (TelnetClient, byte_parser):
+            (a, b) = socket.socketpair()
+            sockets.extend([a, b])
+            clients.append(parser(a, ('test', seed)))
+        setup = rand.randint(0, 3) # Start in echo, password echo, or after offering the usual options.
+        for client in clients:
+            client.telnet_echo = (setup in (1, 2))
+            client.telnet_echo_password = (setup == 2)
+            if(setup == 3):
+                client.request_handshake()
+        for chunk in split(rand, random_stream(rand)):
+            for client in clients:
+                client._scan(chunk)
+                client._frame_lines()
+        self.assertEqual(state(clients[0]), state(clients[1]), 'Parsers differ for seed %d.' % (seed))
+        for item in sockets:
+            item.close()
+
+    def test_random_streams(self):
+        # Random streams, split at random points. Both parsers print complaints about the junk they're fed; keep them quiet.
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            for seed in range(3000):
+                self.run_both(seed)
+        finally:
+            sys.stdout = stdout
+
+if(__name__ == '__main__'):
+    unittest.main()